@@ -0,0 +1,97 @@
+"""Compare the lxml ratings page parser with the old BeautifulSoup one.
+
+Runs over every page-N.html recorded by benchmarks/sync_modes.py:
+
+    python3 benchmarks/parser.py [fixtures_dir] [repeat]
+
+Checks both parsers agree on every page, then times them in this
+process and the lxml one across utils.scrape's process pool.
+"""
+import os
+import sys
+import time
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utils import scrape  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def soup_parse(body, return_unrated=False):
+    # The parser the sync used before utils.scrape, kept as the baseline
+    soup = BeautifulSoup(body, "lxml")
+    ratings = []
+    for review in soup.findAll("li", attrs={"class": "poster-container"}):
+        movie_id = review.find("div", attrs={"class", "film-poster"})[
+            "data-target-link"
+        ].split("/")[-2]
+        rating = review.find("span", attrs={"class": "rating"})
+        if not rating:
+            if not return_unrated:
+                continue
+            rating_id = -1
+        else:
+            rating_id = int(rating["class"][-1].split("-")[-1])
+        ratings.append((movie_id, rating_id))
+    return ratings
+
+
+def load_pages(fixtures):
+    pages = []
+    for root, _, names in os.walk(fixtures):
+        for name in sorted(names):
+            if name.startswith("page-") and name.endswith(".html"):
+                with open(os.path.join(root, name), "rb") as f:
+                    pages.append(f.read())
+    return pages
+
+
+def timed(parse, pages, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for page in pages:
+            parse(page, True)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    fixtures = sys.argv[1] if len(sys.argv) > 1 else FIXTURES
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    pages = load_pages(fixtures)
+    if not pages:
+        sys.exit(f"No page-N.html fixtures under {fixtures}")
+
+    mismatches = sum(
+        soup_parse(page, True) != scrape.parse_ratings_page(page, True)
+        for page in pages
+    )
+    print(f"{len(pages)} pages, {mismatches} where the parsers disagree")
+
+    soup_time = timed(soup_parse, pages, repeat)
+    lxml_time = timed(scrape.parse_ratings_page, pages, repeat)
+
+    pool = scrape.get_pool()
+    # Spin the workers up before timing
+    list(pool.map(scrape.parse_ratings_page, pages[:os.cpu_count()]))
+    start = time.perf_counter()
+    for _ in range(repeat):
+        list(pool.map(scrape.parse_ratings_page, pages, [True] * len(pages)))
+    pool_time = (time.perf_counter() - start) / repeat
+    scrape.close_pool()
+
+    for name, seconds in (
+        ("beautifulsoup", soup_time),
+        ("lxml", lxml_time),
+        (f"lxml, {os.cpu_count()} processes", pool_time),
+    ):
+        print(
+            f"{name:24} {len(pages) / seconds:8.1f} pages/s "
+            f"{soup_time / seconds:5.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
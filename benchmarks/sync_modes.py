@@ -0,0 +1,132 @@
+"""Compare the scraping and API ratings sync paths on recorded fixtures.
+
+Record a member's pages once (needs network and API credentials):
+
+    python3 benchmarks/sync_modes.py record <lb_id> <lid> [fixtures_dir]
+
+then benchmark both parsers against them as often as needed:
+
+    python3 benchmarks/sync_modes.py run [fixtures_dir]
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utils import api, scrape, sync  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+HTML_URL = "https://letterboxd.com/{}/films/by/date/page/{}/"
+
+
+async def record(lb_id, lid, fixtures):
+    user_dir = os.path.join(fixtures, lb_id)
+    os.makedirs(user_dir, exist_ok=True)
+    meta = {"lb_id": lb_id, "lid": lid}
+
+    start, page = time.monotonic(), 0
+    while True:
+        page += 1
+        body = await api.api_call(
+            HTML_URL.format(lb_id, page), letterboxd=False, is_json=False
+        )
+        if b"poster-container" not in body:
+            break
+        with open(os.path.join(user_dir, f"page-{page}.html"), "wb") as f:
+            f.write(body)
+    meta["html"] = {"pages": page - 1, "seconds": time.monotonic() - start}
+
+    start, page = time.monotonic(), 0
+    params = {"member": lid, "memberRelationship": "Watched", "perPage": 100}
+    while True:
+        page += 1
+        # Raw bytes so the fixture size is what went over the wire
+        body = await api.api_call("films", params, is_json=False)
+        with open(os.path.join(user_dir, f"page-{page}.json"), "wb") as f:
+            f.write(body)
+        cursor = json.loads(body).get("next")
+        if not cursor:
+            break
+        params["cursor"] = cursor
+    meta["api"] = {"pages": page, "seconds": time.monotonic() - start}
+
+    with open(os.path.join(user_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    await api.close_session()
+
+
+def load_pages(user_dir, ext):
+    names = [n for n in os.listdir(user_dir) if n.startswith("page-") and n.endswith(ext)]
+    names.sort(key=lambda n: int(n.split("-")[1].split(".")[0]))
+    pages = []
+    for name in names:
+        with open(os.path.join(user_dir, name), "rb") as f:
+            pages.append(f.read())
+    return pages
+
+
+def bench_html(pages, lb_id):
+    # Parse in this process so process_time sees all of the work
+    start = time.process_time()
+    ratings = []
+    for page in pages:
+        ratings += [
+            sync.rating_operation(lb_id, movie_id, rating_id, send_to_db=False)
+            for movie_id, rating_id in scrape.parse_ratings_page(page, True)
+        ]
+    return ratings, time.process_time() - start
+
+
+def bench_api(pages, lb_id, lid):
+    start = time.process_time()
+    ratings = []
+    for page in pages:
+        ratings += sync.api_ratings_operations(
+            json.loads(page)["items"], lb_id, lid, send_to_db=False, return_unrated=True
+        )
+    return ratings, time.process_time() - start
+
+
+def run(fixtures):
+    print(
+        f"{'user':16} {'mode':5} {'pages':>5} {'KiB':>8} {'cpu ms':>8} "
+        f"{'parse p/s':>9} {'fetch p/s':>9} {'ratings':>7}"
+    )
+    for lb_id in sorted(os.listdir(fixtures)):
+        user_dir = os.path.join(fixtures, lb_id)
+        with open(os.path.join(user_dir, "meta.json")) as f:
+            meta = json.load(f)
+
+        results = {}
+        for mode, ext in (("html", ".html"), ("api", ".json")):
+            pages = load_pages(user_dir, ext)
+            if mode == "html":
+                ratings, cpu = bench_html(pages, lb_id)
+            else:
+                ratings, cpu = bench_api(pages, lb_id, meta["lid"])
+            results[mode] = {(r["movie_id"], r["rating_id"]) for r in ratings}
+            fetched = meta[mode]
+            fetch_rate = fetched["pages"] / fetched["seconds"] if fetched["seconds"] else 0
+            print(
+                f"{lb_id:16} {mode:5} {len(pages):5} "
+                f"{sum(map(len, pages)) / 1024:8.0f} {cpu * 1000:8.1f} "
+                f"{len(pages) / cpu if cpu else 0:9.1f} {fetch_rate:9.1f} "
+                f"{len(ratings):7}"
+            )
+
+        only_html = len(results["html"] - results["api"])
+        only_api = len(results["api"] - results["html"])
+        print(f"{'':16} diff: {only_html} only scraped, {only_api} only from the API")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "record":
+        fixtures = sys.argv[4] if len(sys.argv) > 4 else FIXTURES
+        asyncio.get_event_loop().run_until_complete(
+            record(sys.argv[2], sys.argv[3], fixtures)
+        )
+    else:
+        run(sys.argv[2] if len(sys.argv) > 2 else FIXTURES)
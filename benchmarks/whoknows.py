@@ -0,0 +1,176 @@
+"""Compare <wk latency with and without a write on every lookup.
+
+Seeds a guild of synthetic members and ratings on a scratch MongoDB
+server, then runs the database side of whoknows at increasing concurrency:
+
+    python3 benchmarks/whoknows.py [mongodb_url] [members] [films]
+
+"before" is the old path (films upsert, films read, users read, every
+rating of the film), "after" the single aggregation with the film details
+written behind. Alongside latency it counts the database commands each
+lookup sends.
+
+Everything lives in two freshly named scratch databases, the run stops if
+either name already exists, and only those two are dropped afterwards.
+"""
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+from collections import Counter
+
+import motor.motor_asyncio as motor
+from pymongo import monitoring
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from config import SETTINGS  # noqa: E402
+
+RUN = uuid.uuid4().hex[:8]
+GUILD = f"bench_g_{RUN}"
+# Read by utils.mongo on import, so the shared store is a scratch one too
+SETTINGS["global_db"] = f"bench_lbx_{RUN}"
+
+from utils import film, sync  # noqa: E402
+
+LOOKUPS = 200
+CONCURRENCY = (1, 10, 50)
+
+
+class Commands(monitoring.CommandListener):
+    """Counts the commands sent to the server, by name."""
+
+    def __init__(self):
+        self.sent = Counter()
+
+    def started(self, event):
+        self.sent[event.command_name] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+async def seed(db, members, films):
+    shared = sync.shared_db(db)
+    await sync.ensure_indexes(db)
+    lb_ids = [f"user-{i}" for i in range(members)]
+    movie_ids = [f"film-{i}" for i in range(films)]
+    await db.users.insert_many(
+        [{"uid": i, "lb_id": lb_id, "lid": lb_id} for i, lb_id in enumerate(lb_ids)]
+    )
+    await shared.members.insert_many(
+        [{"lb_id": lb_id, "lid": lb_id, "guilds": [db.name]} for lb_id in lb_ids]
+    )
+    ratings = [
+        {"lb_id": lb_id, "movie_id": movie_id, "rating_id": random.randint(-1, 10)}
+        for lb_id in lb_ids
+        for movie_id in movie_ids
+        if random.random() < 0.6
+    ]
+    await shared.ratings.insert_many(ratings)
+    await sync.update_film_averages(db)
+    return movie_ids
+
+
+def details(movie_id):
+    return {
+        "name": movie_id,
+        "link": f"https://letterboxd.com/film/{movie_id}/",
+        "movie_id": movie_id,
+    }
+
+
+async def before(db, movie_id):
+    await db.films.update_one(
+        {"movie_id": movie_id}, {"$set": details(movie_id)}, upsert=True
+    )
+    await db.films.find_one({"movie_id": movie_id})
+    members = await db.users.distinct("lb_id")
+    ratings = sync.shared_db(db).ratings.find(
+        {"movie_id": movie_id, "lb_id": {"$in": members}}
+    ).sort("rating_id", -1)
+    return await ratings.to_list(length=None)
+
+
+async def after(db, movie_id, writer):
+    writer.put(db, details(movie_id))
+    query = film.WhoKnowsQuery(sync.shared_db(db), db.name, movie_id)
+    return await query.summary(20)
+
+
+async def measure(lookup, movie_ids, concurrency, commands):
+    limit = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def timed(movie_id):
+        async with limit:
+            start = time.perf_counter()
+            await lookup(movie_id)
+            latencies.append(time.perf_counter() - start)
+
+    commands.sent.clear()
+    start = time.perf_counter()
+    await asyncio.gather(*(timed(random.choice(movie_ids)) for _ in range(LOOKUPS)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return (
+        statistics.median(latencies) * 1000,
+        latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        LOOKUPS / elapsed,
+        sum(commands.sent.values()) / LOOKUPS,
+    )
+
+
+async def run(url, members, films):
+    commands = Commands()
+    client = motor.AsyncIOMotorClient(url, event_listeners=[commands])
+    scratch = [GUILD, SETTINGS["global_db"]]
+    taken = set(scratch) & set(await client.list_database_names())
+    if taken:
+        client.close()
+        sys.exit(f"Refusing to run, {', '.join(sorted(taken))} already exists")
+
+    db = client[GUILD]
+    writer = film.FilmWriter()
+    try:
+        movie_ids = await seed(db, members, films)
+        print(f"{members} members, {films} films")
+        print(
+            f"{'path':6} {'conc':>4} {'p50 ms':>8} {'p95 ms':>8} "
+            f"{'lookups/s':>9} {'cmds/lookup':>11}"
+        )
+        for concurrency in CONCURRENCY:
+            for name, lookup in (
+                ("before", lambda movie_id: before(db, movie_id)),
+                ("after", lambda movie_id: after(db, movie_id, writer)),
+            ):
+                p50, p95, rate, sent = await measure(
+                    lookup, movie_ids, concurrency, commands
+                )
+                print(
+                    f"{name:6} {concurrency:4} {p50:8.1f} {p95:8.1f} "
+                    f"{rate:9.0f} {sent:11.2f}"
+                )
+        await writer.close()
+    finally:
+        # Only the databases this run created
+        for name in scratch:
+            await client.drop_database(name)
+        client.close()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    asyncio.get_event_loop().run_until_complete(
+        run(
+            args[0] if args else "mongodb://localhost:27017",
+            int(args[1]) if len(args) > 1 else 500,
+            int(args[2]) if len(args) > 2 else 50,
+        )
+    )
@@ -6,17 +6,34 @@ import discord
 import utils.api as api
 from config import SETTINGS, POSTGRES_INFO
 from utils.diary import get_diary_embed
+from utils.film import close_store, get_store, writer
+from utils import mongo, scrape
+from utils.jobs import SyncManager
 
 intents = discord.Intents.default()
 intents.members = True
 
 prefix = SETTINGS["prefix"]
 
-initial_extensions = ["cogs.film", "cogs.ratings", "cogs.follow", "cogs.fun"]
+initial_extensions = [
+    "cogs.film",
+    "cogs.ratings",
+    "cogs.follow",
+    "cogs.fun",
+    "cogs.admin",
+]
 
 
 async def run():
+    # Before any client threads start, see scrape.get_pool
+    scrape.get_pool()
     db = await asyncpg.create_pool(**POSTGRES_INFO)
+    session = api.create_session(**SETTINGS.get("http", {}))
+    api.set_session(session)
+    mongo.set_client(mongo.create_client(**SETTINGS.get("mongo", {})))
+    print(f"Warmed up {get_store().warm()} films from disk")
+    sync_jobs = SyncManager()
+    print(f"Resumed {await sync_jobs.start()} sync jobs")
 
     bot = Bot(
         command_prefix=prefix,
@@ -26,6 +43,8 @@ async def run():
             type=discord.ActivityType.listening, name=f"{prefix}help"
         ),
         db=db,
+        session=session,
+        sync_jobs=sync_jobs,
     )
 
     for extension in initial_extensions:
@@ -51,12 +70,33 @@ class Bot(commands.AutoShardedBot):
         super().__init__(*args, **kwargs)
 
         self.db = kwargs.pop("db")
+        self.session = kwargs.pop("session")
+        self.sync_jobs = kwargs.pop("sync_jobs")
         self.prev_time = datetime.utcnow()
         # self.check_feed.start()
 
     async def on_ready(self):
         print(f"Logged in {len(self.guilds)} servers as {self.user.name}")
 
+    async def close(self):
+        await super().close()
+        await self.sync_jobs.stop()
+        await self.session.close()
+        # Film details still waiting to be written go out before the client closes
+        await writer.close()
+        mongo.close_client()
+        close_store()
+        scrape.close_pool()
+
+    async def invoke(self, ctx):
+        # Count the upstream calls this command makes, see utils.metrics
+        token = api.metrics.start_command()
+        try:
+            await super().invoke(ctx)
+        finally:
+            name = ctx.command.qualified_name if ctx.command else "unknown"
+            api.metrics.finish_command(name, token)
+
     async def on_message(self, message):
         if message.content.startswith(prefix):
             print("The message's content was", message.content)
@@ -117,6 +157,9 @@ ALTER TABLE {schema}.users OWNER to postgres;
         if isinstance(error, commands.MissingRequiredArgument):
             await ctx.send(f"Missing argument, check {prefix}help")
 
+        if isinstance(error, api.LetterboxdError):
+            await ctx.send("Connection to Letterboxd failed, try again later")
+
         print(error)
 
     @tasks.loop(minutes=20)
@@ -141,11 +184,15 @@ ALTER TABLE {schema}.users OWNER to postgres;
                         "include": "DiaryEntryActivity",
                         "where": "OwnActivity",
                     }
-                    activity = await api.api_call(
-                        path=f"member/{row[2]}/activity", params=ratings_request
-                    )
-
-                    if "items" not in activity:
+                    try:
+                        activity = await api.api_call(
+                            path=f"member/{row[2]}/activity",
+                            params=ratings_request,
+                            priority=api.BACKGROUND,
+                            guild=guild[0],
+                        )
+                    except api.LetterboxdError as e:
+                        print(e)
                         continue
 
                     entries = extend([], activity["items"], 4, row[2])
@@ -157,7 +204,9 @@ ALTER TABLE {schema}.users OWNER to postgres;
                         if entry_time > self.prev_time:
                             dids.append(entry["diaryEntry"]["id"])
                     if dids:
-                        d_embed = await get_diary_embed(dids)
+                        d_embed = await get_diary_embed(
+                            dids, priority=api.BACKGROUND, guild=guild[0]
+                        )
                         d_embed.set_author(
                             name=user.display_name,
                             url=f"https://letterboxd.com/{row[1]}",
@@ -186,5 +235,7 @@ class MyHelp(commands.MinimalHelpCommand):
         await channel.send(embed=embed)
 
 
-loop = asyncio.get_event_loop()
-loop.run_until_complete(run())
+if __name__ == "__main__":
+    # Guarded, the parse pool's workers import this module too
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run())
@@ -0,0 +1,78 @@
+from io import BytesIO
+
+import discord
+from discord.ext import commands
+from utils import api, film, mongo, sync
+
+
+class Admin(commands.Cog):
+    """Owner-only maintenance commands."""
+
+    def __init__(self, bot):  # noqa
+        self.bot = bot
+
+    async def cog_check(self, ctx):  # noqa
+        return await self.bot.is_owner(ctx.author)
+
+    @commands.command()
+    async def compact(self, ctx):
+        """Trim and vacuum the on-disk film cache."""
+        async with ctx.typing():
+            films, searches = film.get_store().compact()
+        await ctx.send(
+            f"Removed {films} films and {searches} searches, "
+            f"{film.get_store().stats()['films']} films left"
+        )
+
+    @commands.command()
+    async def checkfilms(self, ctx, repair: bool = False):
+        """Check this server's film averages against a full recompute.
+
+        Use ``checkfilms yes`` to also rewrite the films that are off.
+        """
+        db = mongo.guild_db(ctx.guild.id)
+        async with ctx.typing():
+            mismatched = await sync.check_film_counters(db, repair)
+            if repair and mismatched:
+                await film.refresh_leaderboards(db)
+        text = f"{len(mismatched)} films with counters off"
+        if mismatched:
+            text += (", repaired" if repair else "") + ": " + ", ".join(mismatched[:20])
+        await ctx.send(text)
+
+    @commands.command()
+    async def apistats(self, ctx, fmt: str = ""):
+        """Letterboxd latency per endpoint and upstream calls per command.
+
+        Use ``apistats export`` for the Prometheus text format.
+        """
+        if fmt == "export":
+            data = BytesIO(api.metrics.export().encode())
+            await ctx.send(file=discord.File(data, filename="metrics.txt"))
+            return
+
+        cache = api.cache.stats()
+        lanes = api.scheduler.stats()
+        text = api.metrics.summary()
+        text += (
+            f"\n\ncache: {cache['size']}/{cache['maxsize']} entries, "
+            f"{cache['bytes'] / 2**20:.1f} MiB, "
+            f"{cache['hits']} hits, {cache['misses']} misses, "
+            f"{cache['coalesced']} coalesced"
+        )
+        for lane in ("interactive", "background"):
+            stats = lanes[lane]
+            text += (
+                f"\n{lane}: {stats['depth']} queued, {stats['served']} served, "
+                f"wait {stats['mean_wait'] * 1000:.0f}ms mean "
+                f"{stats['max_wait'] * 1000:.0f}ms max"
+            )
+        if len(text) > 1900:
+            data = BytesIO(text.encode())
+            await ctx.send(file=discord.File(data, filename="apistats.txt"))
+        else:
+            await ctx.send(f"```{text}```")
+
+
+def setup(bot):
+    bot.add_cog(Admin(bot))
@@ -1,21 +1,15 @@
-import aiohttp
 import random
 import discord
 from discord.ext import commands
 from fuzzywuzzy import process
 from imdbpie import Imdb
 from imdb import IMDb
-import motor.motor_asyncio as motor
-from parsel import Selector
 import wikipedia
-from utils import api, diary, film
-from config import conn_url, SETTINGS
+from utils import api, diary, film, mongo
+from config import SETTINGS
 
 prefix = SETTINGS['prefix']
 
-def get_conn_url(db_name):
-    return conn_url + db_name + '?retryWrites=true&w=majority'
-
 async def get_list_id(lid, keywords):
     params = {
         'member': lid,
@@ -90,9 +84,7 @@ class Film(commands.Cog):
         async with conn.transaction():
             async for guild in conn.cursor('SELECT id FROM public.guilds'):
                 if ctx.guild.id == guild[0]:
-                    db_name = f'g{ctx.guild.id}'
-                    client = motor.AsyncIOMotorClient(get_conn_url(db_name))
-                    db = client[db_name]
+                    db = mongo.guild_db(ctx.guild.id)
         await self.db.release(conn)
         embed = await film.get_film_embed(film_keywords, verbosity, db=db)
         if not embed:
@@ -113,14 +105,14 @@ class Film(commands.Cog):
         }
 
         res = await api.api_call('search', params=search_request)
-        res = res['items'][0]['contributor']
-        if res:
+        if res['items']:
+            res = res['items'][0]['contributor']
             await ctx.send(embed=get_crew_embed(self.imdb, self.ia, res, verbosity))
         else:
             await ctx.send(f"No one matches '{crew_keywords}'")
 
     @commands.command(help='Sync your watchlist items')
-    async def wsync(self, ctx, wsize=''):
+    async def wsync(self, ctx):
         conn = await self.db.acquire()
         query = f'''SELECT lid FROM g{ctx.guild.id}.users
                     WHERE uid = {ctx.author.id}
@@ -137,36 +129,19 @@ class Film(commands.Cog):
             return
 
         watchlist_request = {
-            'perPage': 100,
             'memberRelationship': 'InWatchlist',
         }
 
         async with ctx.typing():
-            async with aiohttp.ClientSession() as cs:
-                async with cs.get(f'https://letterboxd.com/{lb_id}/watchlist') as r:
-                    if r.status >= 400 and not wsize:
-                        await ctx.send(f'Please manually add your watchlist size using {prefix}wsync (size)')
-                        return
-                    else:
-                        selector = Selector(text=await r.text())
-                        wsize = int(selector.css('span.watchlist-count')[0].get().split('>')[1].split('\xa0')[0].replace(',', ''))
-            watchlist = await api.api_call(f'member/{lid}/watchlist', params=watchlist_request)
-            film_ids = [film['id'] for film in watchlist['items']]
-            if not watchlist['items']:
+            film_ids = [film['id'] async for film in api.paginate(
+                f'member/{lid}/watchlist', watchlist_request,
+                priority=api.BACKGROUND, guild=ctx.guild.id)]
+            if not film_ids:
                 await ctx.send(f'Private or empty watchlist.')
                 return
 
-            added = len(watchlist['items'])
-            while added < wsize:
-                added += 100
-                watchlist_request['cursor'] = watchlist['next']
-                watchlist = await api.api_call(f'member/{lid}/watchlist', params=watchlist_request)
-                film_ids += [film['id'] for film in watchlist['items']]
-
-            db_name = f'g{ctx.guild.id}'
-            client = motor.AsyncIOMotorClient(get_conn_url(db_name))
-            db = client[db_name]
-            w_details = {'wlist': film_ids, 'wsize': wsize}
+            db = mongo.guild_db(ctx.guild.id)
+            w_details = {'wlist': film_ids, 'wsize': len(film_ids)}
             await db.users.update_one({
                 'lid': lid
             }, {
@@ -185,9 +160,7 @@ class Film(commands.Cog):
         3. To skip the most recently watchlisted 420 films and also skip the oldest 65 films, run ``<wrand 420 65``
         4. To skip the oldest 343 films, run ``<wrand 0 343``
         '''
-        db_name = f'g{ctx.guild.id}'
-        client = motor.AsyncIOMotorClient(get_conn_url(db_name))
-        db = client[db_name]
+        db = mongo.guild_db(ctx.guild.id)
         user = await db.users.find_one({'uid': ctx.author.id})
         if not user:
             ctx.send('User not followed')
@@ -210,10 +183,15 @@ class Film(commands.Cog):
         if not list_id:
             await ctx.send(f"No matching list for '{keywords}'")
             return
-        L = await api.api_call(f'list/{list_id}/entries', params={'perPage': 100})
-        print(L['items'])
-        size_L = len(L['items'])
-        random_film = L['items'][random.randrange(0, size_L)]['film']
+        # Reservoir sample so long lists never have to sit in memory
+        random_film, size_L = None, 0
+        async for entry in api.paginate(f'list/{list_id}/entries'):
+            size_L += 1
+            if random.randrange(size_L) == 0:
+                random_film = entry['film']
+        if not random_film:
+            await ctx.send('That list is empty')
+            return
         embed = await film.get_film_embed(film_id=random_film['id'])
         embed.set_author(name=lb_id, url=f'https://boxd.it/{list_id}')
         await ctx.send(embed=embed)
@@ -1,9 +1,11 @@
 import typing
 import discord
 from discord.ext import commands, menus
-import motor.motor_asyncio as motor
 from utils.diary import get_lid
-from config import SETTINGS, conn_url
+from utils import mongo
+from utils.film import refresh_leaderboards
+from utils.sync import remove_member
+from config import SETTINGS
 
 prefix = SETTINGS['prefix']
 
@@ -22,9 +24,6 @@ class MySource(menus.ListPageSource):
         )
 
 
-def get_conn_url(db_name):
-    return conn_url + db_name + '?retryWrites=true&w=majority'
-
 
 class Follow(commands.Cog):
     def __init__(self, bot):
@@ -54,15 +53,16 @@ class Follow(commands.Cog):
                 "lb_id": lb_id,
                 'lid': lid
             }
-            client = motor.AsyncIOMotorClient(get_conn_url(db_name))
-            db = client[db_name]
+            db = mongo.guild_db(ctx.guild.id)
             users = db.users
 
             await users.update_one({"lb_id": user["lb_id"]},
                                    {"$set": user}, upsert=True)
 
-            await ctx.send(f"Added {lb_id}.")
-            await self.bot.get_cog('Ratings').usync(ctx, member)
+            await self.bot.sync_jobs.submit(ctx.guild.id, member.id,
+                                            label=member.name)
+            await ctx.send(f"Added {lb_id}, their ratings are queued to sync. "
+                           f"Check on it with ``{prefix}syncstatus``.")
         except Exception as e:
             print(e)
             await ctx.send(f'Error, if following somebody besides you, try ``{prefix}follow {lb_id} @them``')
@@ -79,8 +79,7 @@ class Follow(commands.Cog):
         db_name = f'g{ctx.guild.id}'
         lb_id = arg
 
-        client = motor.AsyncIOMotorClient(get_conn_url(db_name))
-        db = client[db_name]
+        db = mongo.guild_db(ctx.guild.id)
 
         conn = await self.db.acquire()
         async with conn.transaction():
@@ -95,12 +94,8 @@ class Follow(commands.Cog):
         await self.db.release(conn)
 
         async with ctx.typing():
-            await db.users.delete_many({'lb_id': lb_id})
-            user_ratings = db.ratings.find({'lb_id': lb_id})
-            async for rating in user_ratings:
-                await db.films.delete_one({'movie_id': rating['movie_id']})
-
-            await db.ratings.delete_many({'lb_id': lb_id})
+            await remove_member(db, lb_id)
+            await refresh_leaderboards(db)
         await ctx.send(f"Removed {lb_id}.")
 
 
@@ -118,9 +113,7 @@ class Follow(commands.Cog):
     async def following(self, ctx):
         follow_list = []
 
-        db_name = f'g{ctx.guild.id}'
-        client = motor.AsyncIOMotorClient(get_conn_url(db_name))
-        db = client[db_name]
+        db = mongo.guild_db(ctx.guild.id)
         async for user in db.users.find({}):
             discord_user = self.bot.get_user(int(user['uid']))
             lb_id = user['lb_id']
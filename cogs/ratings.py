@@ -1,21 +1,51 @@
+import asyncio
+
 import discord
 from discord.ext import commands, menus
-import motor.motor_asyncio as motor
-from aioshell import run
-from config import conn_url, SETTINGS
-from utils.film import who_knows_list, top_films_list, get_link
-from utils import api
+from config import SETTINGS
+from utils.film import who_knows_query, LeaderboardQuery, contribution_films, get_link
+from utils.pages import ListQuery, QuerySource
+from utils import api, film, jobs, mongo, sync
 
 prefix = SETTINGS["prefix"]
 
-
-def get_conn_url(db_name):
-    return conn_url + db_name + "?retryWrites=true&w=majority"
-
-
-class MySource(menus.ListPageSource):
-    def __init__(self, data):
-        super().__init__(data, per_page=20)
+# Seconds between edits of a running sync's progress message
+PROGRESS_INTERVAL = 10
+# Filmography entries resolved against the films collection at once
+CREW_BATCH = 100
+
+
+async def add_contributions(db, contributions, clist, details):
+    """Add a batch of filmscrew rows to ``clist``, returning the role name."""
+    films = await contribution_films(db, contributions)
+    role_name = ""
+    for contrib in contributions:
+        body = ""
+        role_name = contrib["type"]
+        link = get_link(contrib["film"])
+        body += f"[{contrib['film']['name']}]({link}) "
+        if "releaseYear" in contrib["film"]:
+            body += f"({contrib['film']['releaseYear']}) "
+        db_info = films.get(link.split("/")[-2])
+        if db_info:
+            if "guild_avg" in db_info and db_info["rating_count"] != 0:
+                body += f" **{0.5*db_info['guild_avg']:.2f}** ({db_info['rating_count']})"
+                details["cumulative"] += db_info["guild_avg"] * db_info["rating_count"]
+                details["rating_count"] += db_info["rating_count"]
+                if "watch_count" in db_info:
+                    unrated = db_info["watch_count"] - db_info["rating_count"]
+                    body += " " + "✓" * (unrated if unrated < 6 else 6)
+                    details["watch_count"] += db_info["watch_count"]
+            elif "watch_count" in db_info:
+                body += " " + "✓" * db_info["watch_count"]
+                details["watch_count"] += db_info["watch_count"]
+            clist[body] = db_info.get("guild_avg", 0)
+    return role_name
+
+
+class MySource(QuerySource):
+    def __init__(self, query):
+        super().__init__(query, per_page=20)
 
     async def format_page(self, menu, entries):
         offset = menu.current_page * self.per_page
@@ -25,9 +55,9 @@ class MySource(menus.ListPageSource):
         return discord.Embed(description=description)
 
 
-class SeenSource(menus.ListPageSource):
-    def __init__(self, title, details, data):
-        super().__init__(data, per_page=20)
+class SeenSource(QuerySource):
+    def __init__(self, title, details, query):
+        super().__init__(query, per_page=20)
         self.title = title
         self.details = details
 
@@ -62,14 +92,42 @@ class Ratings(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.db = bot.db
-
-    @commands.command(help="Delete all server rating averages")
+        self.jobs = bot.sync_jobs
+
+    def describe(self, job):
+        if job.state == jobs.QUEUED:
+            return f"{job.label}: #{self.jobs.position(job)} in queue"
+        return f"{job.label}: {job.progress}"
+
+    async def wait_for(self, ctx, job, created):
+        """Follow a sync job, editing a status message as it goes."""
+        verb = "Queued" if created else "Already syncing"
+        message = await ctx.send(f"{verb} {self.describe(job)}")
+        while True:
+            done, _ = await asyncio.wait({job.done}, timeout=PROGRESS_INTERVAL)
+            if done:
+                break
+            await message.edit(content=f"Updating {self.describe(job)}")
+        try:
+            job.done.result()
+        except asyncio.CancelledError:
+            await message.edit(content=f"Cancelled updating {job.label}")
+            return False
+        except Exception:
+            await message.edit(content=f"Failed updating {job.label}")
+            return False
+        await message.edit(content=f"Done updating {job.label}: {job.progress}")
+        return True
+
+    @commands.command(help="Rebuild all server rating averages from stored ratings")
     async def hard_reset(self, ctx):
-        db_name = f"g{ctx.guild.id}"
-        client = motor.AsyncIOMotorClient(get_conn_url(db_name))
-        db = client[db_name]
+        db = mongo.guild_db(ctx.guild.id)
         async with ctx.typing():
             await db.films.delete_many({})
+            # Syncs only move the running counters, so rebuild them here
+            await sync.ensure_indexes(db)
+            await sync.update_film_averages(db)
+            await film.refresh_leaderboards(db)
         await ctx.send("Hard reset finished")
 
     @commands.command(
@@ -80,8 +138,7 @@ class Ratings(commands.Cog):
     @commands.cooldown(1, 172800, commands.BucketType.guild)
     async def ssync(self, ctx):
         db_name = f"g{ctx.guild.id}"
-        client = motor.AsyncIOMotorClient(get_conn_url(db_name))
-        db = client[db_name]
+        db = mongo.guild_db(ctx.guild.id)
         users = db.users
 
         conn = await self.db.acquire()
@@ -95,9 +152,10 @@ class Ratings(commands.Cog):
                 )
         await self.db.release(conn)
 
-        async with ctx.typing():
-            r = await run(f"python3 update.py {db_name}")
-            await ctx.send(f"Done updating {ctx.guild.name}")
+        job, created = await self.jobs.submit(ctx.guild.id, label=ctx.guild.name)
+        if not await self.wait_for(ctx, job, created):
+            # Don't hold a failed or cancelled sync against the cooldown
+            ctx.command.reset_cooldown(ctx)
 
     @ssync.error
     async def ssync_handler(self, ctx, error):
@@ -112,34 +170,58 @@ class Ratings(commands.Cog):
     )
     @commands.cooldown(1, 3600, commands.BucketType.user)
     async def usync(self, ctx, member: discord.Member = None):
-        db_name = f"g{ctx.guild.id}"
         member = member or ctx.author
+        db = mongo.guild_db(ctx.guild.id)
 
-        async with ctx.typing():
-            await run(f"python3 update.py {db_name} {member.id}")
-            await ctx.send(f"Done updating {member.name}")
+        user = await db.users.find_one({"uid": member.id})
+        if not user:
+            await ctx.send(f"{member.name} isn't followed, run {prefix}ssync first")
+            return
+
+        job, created = await self.jobs.submit(
+            ctx.guild.id, member.id, label=member.name
+        )
+        await self.wait_for(ctx, job, created)
 
     @usync.error
     async def usync_handler(self, ctx, error):
         if isinstance(error, commands.CommandOnCooldown):
             await ctx.send(f"On cooldown, try again in {error.retry_after:.1f}s")
 
+    @commands.command(help="Show this server's queued and running syncs")
+    async def syncstatus(self, ctx):
+        running = self.jobs.running(ctx.guild.id)
+        queued = self.jobs.queued(ctx.guild.id)
+        lines = [f"Running {self.describe(job)}" for job in running]
+        lines += [f"Queued {self.describe(job)}" for job in queued]
+        if not lines:
+            lines.append("No syncs queued or running")
+        lines.append(
+            f"{len(self.jobs.running())} running and {len(self.jobs.queued())} "
+            f"queued across all servers, {self.jobs.workers} at a time"
+        )
+        await ctx.send("\n".join(lines))
+
+    @commands.command(help="Cancel this server's queued and running syncs")
+    @commands.has_guild_permissions(manage_messages=True)
+    async def cancelsync(self, ctx):
+        cancelled = await self.jobs.cancel(ctx.guild.id)
+        await ctx.send(f"Cancelled {cancelled} sync(s)" if cancelled else "No sync running")
+
     @commands.command(
         aliases=["wk", "seen", prefix + "wk"],
         help="Check *who knows* a film, and their ratings",
     )
     async def whoknows(self, ctx, *, film_keywords):
-        db_name = f"g{ctx.guild.id}"
-        client = motor.AsyncIOMotorClient(get_conn_url(db_name))
-        db = client[db_name]
+        db = mongo.guild_db(ctx.guild.id)
 
         if ctx.invoked_with.count(prefix) == 1:
-            await usync(ctx, ctx.author)
+            await self.usync(ctx, ctx.author)
 
-        title, details, wk_list = await who_knows_list(db, film_keywords)
+        title, details, query = await who_knows_query(db, film_keywords)
         if title:
             pages = menus.MenuPages(
-                source=SeenSource(title, details, wk_list), clear_reactions_after=True
+                source=SeenSource(title, details, query), clear_reactions_after=True
             )
             await pages.start(ctx)
         else:
@@ -156,11 +238,9 @@ class Ratings(commands.Cog):
         if threshold < 1:
             await ctx.send("At least 1 rating")
             return
-        db_name = f"g{ctx.guild.id}"
-        client = motor.AsyncIOMotorClient(get_conn_url(db_name))
-        db = client[db_name]
+        db = mongo.guild_db(ctx.guild.id)
         pages = menus.MenuPages(
-            source=MySource(await top_films_list(db, threshold, -1)),
+            source=MySource(LeaderboardQuery(db, threshold, -1)),
             clear_reactions_after=True,
         )
         await pages.start(ctx)
@@ -180,11 +260,9 @@ class Ratings(commands.Cog):
         if threshold < 1:
             await ctx.send("At least 1 rating")
             return
-        db_name = f"g{ctx.guild.id}"
-        client = motor.AsyncIOMotorClient(get_conn_url(db_name))
-        db = client[db_name]
+        db = mongo.guild_db(ctx.guild.id)
         pages = menus.MenuPages(
-            source=MySource(await top_films_list(db, threshold, 1)),
+            source=MySource(LeaderboardQuery(db, threshold, 1)),
             clear_reactions_after=True,
         )
         await pages.start(ctx)
@@ -213,10 +291,10 @@ class Ratings(commands.Cog):
         }
 
         res = await api.api_call("search", params=search_request)
-        crew = res["items"][0]["contributor"]
-        if not crew:
+        if not res["items"]:
             await ctx.send(f"Nobody found matching {crew_keywords}")
             return
+        crew = res["items"][0]["contributor"]
 
         TYPE_CONTRIB = {
             "a": "Actor",
@@ -227,59 +305,38 @@ class Ratings(commands.Cog):
             "w": "Writer",
         }
 
-        contrib_req = {"perPage": 60, "type": TYPE_CONTRIB[role]}
-        res = await api.api_call(
-            f"contributor/{crew['id']}/contributions", params=contrib_req
-        )
-        if "items" not in res:
-            await ctx.send("Connection to Letterboxd failed")
-            return
-
+        contrib_req = {"type": TYPE_CONTRIB[role]}
         clist, details = {}, {"cumulative": 0, "rating_count": 0, "watch_count": 0}
-        db_name = f"g{ctx.guild.id}"
-        client = motor.AsyncIOMotorClient(get_conn_url(db_name))
-        db = client[db_name]
+        db = mongo.guild_db(ctx.guild.id)
         role_name = ""
         async with ctx.typing():
-            for contrib in res["items"]:
-                body = ""
-                role_name = contrib["type"]
-                link = get_link(contrib["film"])
-                body += f"[{contrib['film']['name']}]({link}) "
-                if "releaseYear" in contrib["film"]:
-                    body += f"({contrib['film']['releaseYear']}) "
-                if db:
-                    movie_id = link.split("/")[-2]
-                    db_info = await db.films.find_one({"movie_id": movie_id})
-                    if db_info:
-                        if "guild_avg" in db_info and db_info["rating_count"] != 0:
-                            body += f" **{0.5*db_info['guild_avg']:.2f}** ({db_info['rating_count']})"
-                            details["cumulative"] += (
-                                db_info["guild_avg"] * db_info["rating_count"]
-                            )
-                            details["rating_count"] += db_info["rating_count"]
-                            if "watch_count" in db_info:
-                                unrated = (
-                                    db_info["watch_count"] - db_info["rating_count"]
-                                )
-                                body += " " + "✓" * (unrated if unrated < 6 else 6)
-                                details["watch_count"] += db_info["watch_count"]
-                        elif "watch_count" in db_info:
-                            body += " " + "✓" * db_info["watch_count"]
-                            details["watch_count"] += db_info["watch_count"]
-                        clist[body] = db_info["guild_avg"]
-                else:
-                    clist[body] = -1
+            # One films lookup per page of the filmography
+            batch = []
+            async for contrib in api.paginate(
+                f"contributor/{crew['id']}/contributions",
+                contrib_req,
+                per_page=CREW_BATCH,
+            ):
+                batch.append(contrib)
+                if len(batch) >= CREW_BATCH:
+                    role_name = await add_contributions(db, batch, clist, details)
+                    batch = []
+            if batch:
+                role_name = await add_contributions(db, batch, clist, details)
 
         crew_list = [
             k for k, v in sorted(clist.items(), key=lambda item: item[1], reverse=True)
         ]
-        print(crew_list)
         details["link"] = "https://boxd.it/" + crew["id"]
-        details["guild_avg"] = details["cumulative"] / details["rating_count"]
+        details["guild_avg"] = (
+            details["cumulative"] / details["rating_count"]
+            if details["rating_count"]
+            else 0.0
+        )
         title = f"{role_name} {crew['name']}"
         pages = menus.MenuPages(
-            source=SeenSource(title, details, crew_list), clear_reactions_after=True
+            source=SeenSource(title, details, ListQuery(crew_list)),
+            clear_reactions_after=True,
         )
         await pages.start(ctx)
 
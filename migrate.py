@@ -0,0 +1,89 @@
+import asyncio
+import re
+import sys
+from datetime import datetime
+
+from pymongo import UpdateOne
+
+from utils import film, mongo, sync
+
+GUILD_DB = re.compile(r'^g\d+$')
+
+
+def synced_at(user):
+    return user.get('sync_mark', {}).get('synced_at', datetime.min)
+
+
+async def copy_ratings(source, shared, lb_id):
+    copied, batch = 0, []
+    async for rating in source.ratings.find({'lb_id': lb_id}):
+        batch.append(UpdateOne({'lb_id': lb_id, 'movie_id': rating['movie_id']},
+                               {'$set': {'rating_id': rating['rating_id']}}, upsert=True))
+        if len(batch) >= sync.WRITE_BATCH:
+            await shared.ratings.bulk_write(batch, ordered=False)
+            copied += len(batch)
+            batch = []
+    if batch:
+        await shared.ratings.bulk_write(batch, ordered=False)
+        copied += len(batch)
+    return copied
+
+
+async def migrate(drop=False):
+    """Move every guild's ratings into the shared store, once per user.
+
+    A user followed in several guilds is copied from the guild that
+    synced them last, along with that guild's watermark.
+    """
+    client = mongo.get_client()
+    shared = mongo.global_db()
+    try:
+        guild_dbs = [client[name] for name in await client.list_database_names()
+                     if GUILD_DB.match(name)]
+
+        # lb_id -> (newest user document, its guild db) and every guild following them
+        newest, guilds = {}, {}
+        before = 0
+        for db in guild_dbs:
+            await sync.ensure_indexes(db)
+            before += await db.ratings.count_documents({})
+            async for user in db.users.find({}):
+                lb_id = user['lb_id']
+                guilds.setdefault(lb_id, set()).add(db.name)
+                if lb_id not in newest or synced_at(user) > synced_at(newest[lb_id][0]):
+                    newest[lb_id] = (user, db)
+
+        after = 0
+        for lb_id, (user, source) in newest.items():
+            member = {'lid': user['lid']}
+            for field in ('sync_mark', 'num_ratings_pages'):
+                if field in user:
+                    member[field] = user[field]
+            await shared.members.update_one(
+                {'lb_id': lb_id},
+                {'$set': member, '$addToSet': {'guilds': {'$each': sorted(guilds[lb_id])}}},
+                upsert=True)
+            after += await copy_ratings(source, shared, lb_id)
+        print(f'Copied {after} of {before} ratings for {len(newest)} users '
+              f'from {len(guild_dbs)} guilds')
+
+        for db in guild_dbs:
+            await sync.update_film_averages(db)
+            await film.refresh_leaderboards(db)
+            if drop:
+                await db.ratings.drop()
+                await db.users.update_many({}, {'$unset': {'sync_mark': '', 'num_ratings_pages': ''}})
+        print('Recomputed guild averages and leaderboards' + (', dropped guild ratings' if drop else ''))
+    finally:
+        mongo.close_client()
+
+
+def main():
+    # migrate.py [--drop], --drop deletes the per-guild ratings collections
+    # once they are copied, leave it off for a first run to compare both
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(migrate(drop='--drop' in sys.argv))
+
+
+if __name__ == "__main__":
+    main()
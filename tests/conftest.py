@@ -0,0 +1,14 @@
+import sys
+import types
+
+# config.py holds the bot's secrets and isn't checked in, so give the
+# modules under test a minimal one
+if "config" not in sys.modules:
+    config = types.ModuleType("config")
+    config.SETTINGS = {
+        "prefix": "<",
+        "letterboxd": {"api_base": "", "api_key": "", "api_secret": ""},
+    }
+    config.conn_url = "mongodb://localhost:27017/"
+    config.POSTGRES_INFO = {}
+    sys.modules["config"] = config
@@ -0,0 +1,72 @@
+import asyncio
+import time
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from utils import api
+from utils.ratelimit import TokenBucket
+
+
+def run_against(responses, call):
+    """Serve ``responses`` in order to ``call``, returning its outcome and
+    the times the requests arrived."""
+    arrived = []
+
+    async def handler(request):
+        arrived.append(time.monotonic())
+        status, headers, body = responses[min(len(arrived), len(responses)) - 1]
+        return web.json_response(body, status=status, headers=headers)
+
+    async def main():
+        app = web.Application()
+        app.router.add_get("/films", handler)
+        server = TestServer(app)
+        await server.start_server()
+        api.SETTINGS["letterboxd"]["api_base"] = str(server.make_url("/"))
+        try:
+            return await call()
+        finally:
+            await api.close_session()
+            await server.close()
+
+    return asyncio.run(main()), arrived
+
+
+@pytest.fixture(autouse=True)
+def letterboxd(monkeypatch):
+    monkeypatch.setitem(
+        api.SETTINGS,
+        "letterboxd",
+        {"api_base": "", "api_key": "key", "api_secret": "secret"},
+    )
+    # Fresh pacing per test, and no jittered sleeps between retries
+    monkeypatch.setattr(api, "limiter", TokenBucket(rate=100, burst=10))
+    monkeypatch.setattr(api, "backoff", lambda attempt: 0)
+
+
+def test_retries_server_errors():
+    responses = [(503, {}, {}), (200, {}, {"items": [1]})]
+    result, arrived = run_against(responses, lambda: api.api_call("films"))
+    assert result == {"items": [1]}
+    assert len(arrived) == 2
+
+
+def test_waits_out_retry_after():
+    responses = [(429, {"Retry-After": "1"}, {}), (200, {}, {"items": []})]
+    result, arrived = run_against(responses, lambda: api.api_call("films"))
+    assert result == {"items": []}
+    assert len(arrived) == 2
+    assert arrived[1] - arrived[0] >= 0.9
+
+
+def test_client_errors_are_not_retried():
+    async def call():
+        with pytest.raises(api.LetterboxdError) as error:
+            await api.api_call("films")
+        return error.value
+
+    error, arrived = run_against([(404, {}, {})], call)
+    assert error.status == 404
+    assert len(arrived) == 1
@@ -0,0 +1,57 @@
+import asyncio
+import types
+
+import pytest
+
+from utils import sync
+
+
+class Collection:
+    def __init__(self, docs=()):
+        self.docs = list(docs)
+
+    def find(self, *args, **kwargs):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self.docs:
+            yield doc
+
+
+def run_sync(lb_ids):
+    shared = types.SimpleNamespace(members=Collection())
+    # Fails rather than hangs if a dead stage leaves the pipeline waiting
+    return asyncio.run(asyncio.wait_for(sync.get_ratings(shared, lb_ids), 5))
+
+
+@pytest.fixture(autouse=True)
+def pipeline(monkeypatch):
+    async def fetch(url, guild=None):
+        return b""
+
+    async def parse_page(body, first=False):
+        ratings = [("film", 8)]
+        return (1, ratings) if first else ratings
+
+    monkeypatch.setattr(sync, "fetch", fetch)
+    monkeypatch.setattr(sync, "parse_page", parse_page)
+    # Every page is its own bulk write, so the writer stage does the writing
+    monkeypatch.setattr(sync, "WRITE_BATCH", 1)
+
+
+def test_writer_error_fails_the_sync(monkeypatch):
+    async def write_ratings(shared, ratings):
+        raise ConnectionError("lost the primary")
+
+    monkeypatch.setattr(sync, "write_ratings", write_ratings)
+    with pytest.raises(ConnectionError):
+        run_sync(["user-1", "user-2"])
+
+
+def test_fetch_error_fails_the_sync(monkeypatch):
+    async def fetch(url, guild=None):
+        raise RuntimeError("not a LetterboxdError")
+
+    monkeypatch.setattr(sync, "fetch", fetch)
+    with pytest.raises(RuntimeError):
+        run_sync(["user-1"])
@@ -1,6 +1,7 @@
 import asyncio
 import hashlib
 import hmac
+import re
 import string
 import time
 import uuid
@@ -8,31 +9,189 @@ import urllib.parse
 
 import aiohttp
 from config import SETTINGS
+from utils.cache import TTLCache
+from utils.metrics import Metrics, endpoint_template
+from utils.ratelimit import TokenBucket, backoff, retry_after
+from utils.scheduler import RequestScheduler, INTERACTIVE, BACKGROUND
 
 class LetterboxdError(Exception):
-    pass
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
 
-async def api_call(path, params=None, letterboxd=True, is_json=True):
-    if not params:
-        params = dict()
-        api_url = path
-    if letterboxd:
-        url = SETTINGS['letterboxd']['api_base'] + path
-        params['apikey'] = SETTINGS['letterboxd']['api_key']
-        params['nonce'] = str(uuid.uuid4())
-        params['timestamp'] = int(time.time())
-        url += '?' + urllib.parse.urlencode(params)
-        api_url = url + '&signature=' +  __sign(url)
-    async with aiohttp.ClientSession() as cs:
-        async with cs.get(api_url) as r:
-            if r.status >= 400:
-                return ''
-            if is_json:
-                response = await r.json()
-            else:
-                response = await r.read()
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRIES = SETTINGS.get('ratelimit', {}).get('retries', 4)
+
+# Seconds to keep each class of response around, first match wins.
+# Anything not listed here (activity, watchlists, ...) is never cached.
+CACHE_TTLS = [
+    (re.compile(r'^film/[^/]+$'), 24 * 3600),
+    (re.compile(r'^film/[^/]+/statistics$'), 5 * 60),
+    (re.compile(r'^search$'), 3600),
+    # Filmographies, one entry per page cursor
+    (re.compile(r'^contributor/[^/]+/contributions$'), 6 * 3600),
+]
+
+# Entries count against max_bytes by response body length, so a few large
+# filmographies can't take the memory of thousands of small lookups
+cache = TTLCache(**{'max_bytes': 64 * 1024 * 1024, **SETTINGS.get('cache', {})})
+# Shared budget for every call to the Letterboxd API
+limiter = TokenBucket(
+    rate=SETTINGS.get('ratelimit', {}).get('rate', 5.0),
+    burst=SETTINGS.get('ratelimit', {}).get('burst', 10))
+metrics = Metrics()
+# Orders requests waiting for upstream capacity, see utils.scheduler
+scheduler = RequestScheduler(**SETTINGS.get('scheduler', {}))
+
+_session = None
+
+def create_session(limit=100, limit_per_host=20, dns_ttl=300,
+                   keepalive=30, timeout=30):
+    # One pooled session for the bot's lifetime: connections to the same
+    # host are kept alive and reused, and DNS lookups are cached
+    connector = aiohttp.TCPConnector(
+        limit=limit,
+        limit_per_host=limit_per_host,
+        use_dns_cache=True,
+        ttl_dns_cache=dns_ttl,
+        keepalive_timeout=keepalive)
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=timeout))
+
+def set_session(session):
+    global _session
+    _session = session
+
+def get_session():
+    global _session
+    if _session is None or _session.closed:
+        _session = create_session(**SETTINGS.get('http', {}))
+    return _session
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+def cache_ttl(path):
+    for pattern, ttl in CACHE_TTLS:
+        if pattern.match(path):
+            return ttl
+    return None
+
+async def api_call(path, params=None, letterboxd=True, is_json=True,
+                   priority=INTERACTIVE, guild=None):
+    params = dict(params) if params else dict()
+    ttl = cache_ttl(path) if letterboxd and is_json else None
+    if ttl is None:
+        response, _ = await _request(path, params, letterboxd, is_json, priority, guild)
+        return response
+
+    key = (path, tuple(sorted(params.items())))
+    # Stored as (response, body length)
+    response, _ = await cache.get_or_fetch(
+        key, ttl,
+        lambda: _request(path, params, letterboxd, is_json, priority, guild),
+        size=lambda entry: entry[1])
     return response
 
+async def _request(path, params, letterboxd, is_json, priority, guild):
+    template = endpoint_template(path, letterboxd)
+    start = time.monotonic()
+    for attempt in range(MAX_RETRIES + 1):
+        api_url = path
+        try:
+            async with scheduler.slot(priority, guild):
+                if letterboxd:
+                    await limiter.acquire()
+                    # Nonce and timestamp have to be fresh for every attempt
+                    url = SETTINGS['letterboxd']['api_base'] + path
+                    params['apikey'] = SETTINGS['letterboxd']['api_key']
+                    params['nonce'] = str(uuid.uuid4())
+                    params['timestamp'] = int(time.time())
+                    url += '?' + urllib.parse.urlencode(params)
+                    api_url = url + '&signature=' +  __sign(url)
+                async with get_session().get(api_url) as r:
+                    status = r.status
+                    body = await r.read()
+                    if status < 400:
+                        response = await r.json() if is_json else body
+                    else:
+                        wait = retry_after(r.headers.get('Retry-After'))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == MAX_RETRIES:
+                metrics.record(template, 0, 0, time.monotonic() - start, attempt)
+                raise LetterboxdError(f'{path}: {e!r}') from e
+            await asyncio.sleep(backoff(attempt))
+            continue
+
+        if status < 400 or status not in RETRY_STATUSES or attempt == MAX_RETRIES:
+            metrics.record(template, status, len(body), time.monotonic() - start, attempt)
+            if status < 400:
+                return response, len(body)
+            raise LetterboxdError(f'{path}: HTTP {status}', status)
+        if status == 429 and wait is not None:
+            if letterboxd:
+                limiter.block_for(wait)
+            await asyncio.sleep(wait)
+        else:
+            await asyncio.sleep(backoff(attempt))
+
+async def gather_limited(aws, limit=4):
+    """Await several coroutines with at most ``limit`` running at once.
+
+    Results come back in order. One that failed with a LetterboxdError
+    leaves the error in its place instead of failing the whole batch.
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(aw):
+        async with semaphore:
+            try:
+                return await aw
+            except LetterboxdError as e:
+                return e
+
+    return await asyncio.gather(*(run(aw) for aw in aws))
+
+async def batch_call(calls, limit=4):
+    """gather_limited over api_call, ``calls`` holding either paths or
+    dicts of api_call keyword arguments."""
+    return await gather_limited(
+        (api_call(call) if isinstance(call, str) else api_call(**call)
+         for call in calls),
+        limit)
+
+async def paginate(path, params=None, limit=None, per_page=100, **kwargs):
+    """Yield the items of a cursor-paginated endpoint, up to ``limit``.
+
+    The next page is requested as soon as the current one arrives, so it
+    downloads while the caller works through the current items.
+    """
+    params = dict(params) if params else dict()
+    params['perPage'] = min(per_page, limit) if limit else per_page
+    page_task = asyncio.ensure_future(api_call(path, params, **kwargs))
+    count = 0
+    try:
+        while page_task is not None:
+            page = await page_task
+            page_task = None
+            items = page.get('items', [])
+            cursor = page.get('next')
+            if cursor and items and (limit is None or count + len(items) < limit):
+                params = dict(params, cursor=cursor)
+                page_task = asyncio.ensure_future(api_call(path, params, **kwargs))
+            for item in items:
+                yield item
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+    finally:
+        if page_task is not None:
+            page_task.cancel()
+
 def __sign(url, body=''):
     # Create the salted bytestring
     signing_bytestring = b'\x00'.join(
@@ -0,0 +1,105 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """LRU cache whose entries also expire after a per-entry TTL.
+
+    Bounded by entry count and, with ``max_bytes``, by the summed size
+    recorded for each entry when it was stored. Concurrent
+    ``get_or_fetch`` calls for the same key share a single in-flight
+    fetch instead of each hitting the upstream.
+    """
+
+    def __init__(self, maxsize=4096, max_bytes=None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._data = OrderedDict()
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires, value, size = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            self.bytes -= size
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl, size=0):
+        self.pop(key)
+        if self.max_bytes is not None and size > self.max_bytes:
+            # Would push out everything else and still not fit
+            return
+        self._data[key] = (time.monotonic() + ttl, value, size)
+        self.bytes += size
+        while self._data and (
+            len(self._data) > self.maxsize
+            or (self.max_bytes is not None and self.bytes > self.max_bytes)
+        ):
+            _, (_, _, evicted) = self._data.popitem(last=False)
+            self.bytes -= evicted
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return default
+        self.bytes -= entry[2]
+        return entry[1]
+
+    def clear(self):
+        self._data.clear()
+        self.bytes = 0
+
+    async def get_or_fetch(self, key, ttl, fetch, size=None):
+        """Cached value for ``key``, else the result of ``fetch()``, stored
+        with ``size(result)`` counted against max_bytes."""
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            self.hits += 1
+            return value
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(fetch())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._fetched(key, ttl, size, t))
+        # Shield so one caller being cancelled doesn't fail the others
+        return await asyncio.shield(task)
+
+    def _fetched(self, key, ttl, size, task):
+        self._inflight.pop(key, None)
+        # Failures are never cached, the next lookup tries again
+        if task.cancelled() or task.exception() is not None:
+            return
+        value = task.result()
+        self.set(key, value, ttl, size(value) if size else 0)
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'hit_rate': (self.hits + self.coalesced) / lookups if lookups else 0.0,
+        }
@@ -5,10 +5,15 @@ from .film import get_link
 from utils import api
 
 
-async def get_diary_embed(dids):
+async def get_diary_embed(dids, priority=api.INTERACTIVE, guild=None):
     description = ''
-    for did in dids:
-        d_entry = await api.api_call(path=f'log-entry/{did}')
+    d_entries = await api.batch_call([
+        {'path': f'log-entry/{did}', 'priority': priority, 'guild': guild}
+        for did in dids])
+    for d_entry in d_entries:
+        if isinstance(d_entry, api.LetterboxdError):
+            print(d_entry)
+            continue
         film = d_entry['film']
         description += f"**[{film['name']} ({film['releaseYear']})]"
         description += f'({get_link(d_entry)})**\n'
@@ -26,11 +31,11 @@ async def get_diary_embed(dids):
             if d_entry['review']['containsSpoilers']:
                 description += '\n```Contains spoilers```'
             else:
-                description += '\n```'
-                + markdownify(d_entry['review']['text'][:1600]) + '```'
+                description += ('\n```'
+                                + markdownify(d_entry['review']['text'][:1600]) + '```')
         description += '\n'
     embed = discord.Embed(description=description)
-    if 'poster' in film:
+    if description and 'poster' in film:
         embed.set_thumbnail(url=film['poster']['sizes'][-1]['url'])
 
     return embed
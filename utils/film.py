@@ -1,5 +1,22 @@
+import asyncio
+import traceback
+from datetime import datetime
+
 from discord import Embed
-from utils.api import api_call
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+from config import SETTINGS
+from utils.api import api_call, gather_limited, LetterboxdError
+from utils.cache import TTLCache
+from utils.filmstore import FilmStore
+from utils.sync import shared_db
+
+_store = None
+
+# Minimum rating counts <topf and <lowf keep a precomputed board for,
+# any other threshold is ranked on request
+LEADERBOARD_THRESHOLDS = SETTINGS.get("leaderboard_thresholds", [1, 2, 3, 4, 5, 10, 15, 20, 25, 50])
+LEADERBOARD_SIZE = 200
 
 
 async def get_film_embed(film_keywords="", verbosity=0, film_id="", db=None):
@@ -8,8 +25,14 @@ async def get_film_embed(film_keywords="", verbosity=0, film_id="", db=None):
         if not film:
             return None
         film_id = film["id"]
-    film_details = await api_call(f"film/{film_id}")
-    film_stats = await api_call(f"film/{film_id}/statistics")
+    film_details, film_stats = await gather_limited(
+        [get_film_details(film_id), api_call(f"film/{film_id}/statistics")]
+    )
+    if isinstance(film_details, LetterboxdError):
+        raise film_details
+    if isinstance(film_stats, LetterboxdError):
+        # Still worth showing the film without its statistics
+        film_stats = {}
 
     title = f"{film_details['name']}"
     if "releaseYear" in film_details:
@@ -67,7 +90,9 @@ async def get_description(film_details, film_stats, verbosity=0, db=None):
         description += f"{human_count(film_stats['counts']['ratings'])} ratings, "
     else:
         description += "\n"
-    description += f"{human_count(film_stats['counts']['watches'])} watched\n"
+    if "counts" in film_stats:
+        description += f"{human_count(film_stats['counts']['watches'])} watched"
+    description += "\n"
 
     if db:
         movie_id = get_link(film_details).split("/")[-2]
@@ -86,42 +111,234 @@ async def get_description(film_details, film_stats, verbosity=0, db=None):
     return description
 
 
+def get_store():
+    """The film store, opened on first use."""
+    global _store
+    if _store is None:
+        _store = FilmStore(**SETTINGS.get("film_store", {}))
+    return _store
+
+
+def close_store():
+    global _store
+    if _store is not None:
+        _store.close()
+    _store = None
+
+
+async def get_film_details(film_id):
+    store = get_store()
+    film = store.get(film_id)
+    # The read only noted the use, have it written behind
+    writer.schedule()
+    if film:
+        return film
+    try:
+        return store.put(await api_call(f"film/{film_id}"))
+    except LetterboxdError:
+        # Better an outdated embed than none at all
+        film = store.get(film_id, stale=True)
+        if not film:
+            raise
+        return film
+
+
 async def get_search_result(film_keywords: str):
+    film = get_store().search(film_keywords)
+    if film:
+        return film
+
     search_request = {"perPage": 1, "input": film_keywords, "include": "FilmSearchItem"}
 
     search_response = await api_call("search", params=search_request)
 
     if not search_response["items"]:
         return None
-    return search_response["items"][0]["film"]
+    film = search_response["items"][0]["film"]
+    get_store().put_search(film_keywords, film)
+    return film
+
+
+class FilmWriter:
+    """Debounced write-behind of film details into guild films collections.
+
+    Lookups queue the details they showed and return, repeated lookups of
+    a film within ``delay`` seconds collapse into one write, and details
+    already written in the last ``fresh`` seconds aren't written again.
+    Each flush also writes the film store's recorded uses.
+    """
+
+    def __init__(self, delay=30, fresh=3600):
+        self.delay = delay
+        self.fresh = fresh
+        # (db name, movie_id) -> (db, details)
+        self._pending = {}
+        self._written = TTLCache()
+        self._task = None
+
+    def put(self, db, details):
+        key = (db.name, details["movie_id"])
+        if self._written.get(key) == details:
+            return
+        self._pending[key] = (db, details)
+        self.schedule()
+
+    def schedule(self):
+        """Flush in ``delay`` seconds, unless a flush is already due."""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.delay)
+        self._task = None
+        await self.flush()
+
+    async def flush(self):
+        if _store is not None:
+            _store.flush_touches()
+        pending, self._pending = self._pending, {}
+        by_db = {}
+        for key, (db, details) in pending.items():
+            by_db.setdefault(db.name, (db, []))[1].append((key, details))
+        for db, films in by_db.values():
+            try:
+                await db.films.bulk_write(
+                    [
+                        UpdateOne(
+                            {"movie_id": details["movie_id"]},
+                            {"$set": details},
+                            upsert=True,
+                        )
+                        for _, details in films
+                    ],
+                    ordered=False,
+                )
+            except PyMongoError:
+                # Dropped, the film's next lookup queues it again
+                traceback.print_exc()
+                continue
+            for key, details in films:
+                self._written.set(key, details, self.fresh)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+
+writer = FilmWriter(**SETTINGS.get("film_writer", {}))
+
+
+class WhoKnowsQuery:
+    """A guild's ratings of one film, best first.
+
+    Reads the shared store only: the guild's members come from the
+    members collection, the same set the film counters are kept for.
+    """
+
+    def __init__(self, shared, guild, movie_id):
+        self.shared = shared
+        self.guild = guild
+        self.movie_id = movie_id
+        self.total = None
+        self._first = []
+
+    def pipeline(self):
+        # From each member to their rating of the film. let/$expr rather
+        # than localField plus pipeline, which needs MongoDB 5.0, an $eq
+        # in $expr still uses the (lb_id, movie_id) index
+        return [
+            {"$match": {"guilds": self.guild}},
+            {
+                "$lookup": {
+                    "from": "ratings",
+                    "let": {"lb_id": "$lb_id"},
+                    "pipeline": [
+                        {
+                            "$match": {
+                                "movie_id": self.movie_id,
+                                "$expr": {"$eq": ["$lb_id", "$$lb_id"]},
+                            }
+                        }
+                    ],
+                    "as": "rating",
+                }
+            },
+            {"$unwind": "$rating"},
+            {"$project": {"_id": 0, "lb_id": 1, "rating_id": "$rating.rating_id"}},
+            # lb_id breaks ties so pages don't overlap
+            {"$sort": {"rating_id": -1, "lb_id": 1}},
+        ]
+
+    async def summary(self, limit):
+        """The film's guild stats and first ``limit`` rows, from one aggregation."""
+        rated = {"$ne": ["$rating_id", -1]}
+        cursor = self.shared.members.aggregate(
+            self.pipeline()
+            + [
+                {
+                    "$facet": {
+                        "rows": [{"$limit": limit}],
+                        "stats": [
+                            {
+                                "$group": {
+                                    "_id": None,
+                                    "sum": {"$sum": {"$cond": [rated, "$rating_id", 0]}},
+                                    "rating_count": {"$sum": {"$cond": [rated, 1, 0]}},
+                                    "watch_count": {"$sum": 1},
+                                }
+                            }
+                        ],
+                    }
+                }
+            ]
+        )
+        result = (await cursor.to_list(length=1))[0]
+        stats = result["stats"][0] if result["stats"] else {}
+        rating_count = stats.get("rating_count", 0)
+        self.total = stats.get("watch_count", 0)
+        self._first = result["rows"]
+        return {
+            "guild_avg": stats["sum"] / rating_count if rating_count else 0.0,
+            "rating_count": rating_count,
+            "watch_count": self.total,
+        }
+
+    async def count(self):
+        if self.total is None:
+            await self.summary(1)
+        return self.total
+
+    async def fetch(self, skip, limit):
+        if skip + limit <= len(self._first) or len(self._first) == self.total:
+            ratings = self._first[skip : skip + limit]  # noqa
+        else:
+            cursor = self.shared.members.aggregate(
+                self.pipeline() + [{"$skip": skip}, {"$limit": limit}]
+            )
+            ratings = await cursor.to_list(length=None)
 
+        rows = []
+        for rating in ratings:
+            lb_id = rating["lb_id"]
+            rating_id = rating["rating_id"]
+            if rating_id == -1:
+                rating_id = "✓"
+            rows.append(f"[{lb_id}](https://letterboxd.com/{lb_id}) **{rating_id}**")
+        return rows
 
-async def who_knows_list(db, film_keywords):
-    ratings = db.ratings
-    films = db.films
 
+async def who_knows_query(db, film_keywords, per_page=20):
     film_res = await get_search_result(film_keywords)
     if not film_res:
-        return None
+        return None, None, None
 
     link = get_link(film_res)
     movie_id = link.split("/")[-2]
 
     details = {"name": film_res["name"], "link": link}
 
-    total, r_count, ur_count = 0, 0, 0
-    wk_list = []
-    async for rating in ratings.find({"movie_id": movie_id}).sort("rating_id", -1):
-        lb_id = rating["lb_id"]
-        rating_id = rating["rating_id"]
-        if rating_id == -1:
-            rating_id = "✓"
-            ur_count += 1
-        else:
-            total += rating_id
-            r_count += 1
-        wk_list.append(f"[{lb_id}](https://letterboxd.com/{lb_id}) **{rating_id}**")
-
     title = f"Who knows {film_res['name']}"
     if "releaseYear" in film_res:
         title += " (" + str(film_res["releaseYear"]) + ")"
@@ -131,40 +348,126 @@ async def who_knows_list(db, film_keywords):
         url = film_res["poster"]["sizes"][-1]["url"]
         details["poster_url"] = url
 
-    avg = total / r_count if r_count > 0 else 0
     details["movie_id"] = movie_id
-    details["guild_avg"] = avg
-    details["rating_count"] = r_count
-    details["watch_count"] = r_count + ur_count
-    await films.update_one({"movie_id": movie_id}, {"$set": details}, upsert=True)
+    # Nothing is written while answering, the films collection catches up
+    # with the details in the background
+    writer.put(db, dict(details))
 
-    return title, details, wk_list
+    query = WhoKnowsQuery(shared_db(db), db.name, movie_id)
+    details.update(await query.summary(per_page))
+    return title, details, query
 
 
-async def top_films_list(db, threshold, order):
-    top_films = db.films.find({"rating_count": {"$gt": threshold - 1}}).sort(
-        "guild_avg", order
+async def contribution_films(db, contributions):
+    """Guild films documents for a batch of contributions, by movie_id."""
+    movie_ids = [get_link(contrib["film"]).split("/")[-2] for contrib in contributions]
+    films = db.films.find(
+        {"movie_id": {"$in": movie_ids}},
+        {"movie_id": 1, "guild_avg": 1, "rating_count": 1, "watch_count": 1, "_id": 0},
     )
+    return {film["movie_id"]: film async for film in films}
 
-    topf_short = []
-    counter = 0
-    async for film in top_films:
-        if counter == 200:
-            break
-        movie_id = film["movie_id"]
-        movie_name = (
-            film["name"]
-            if "name" in film
-            else " ".join(
-                [r.capitalize() for r in movie_id.split("-") if not r.isdigit()]
-            )
+
+def film_name(film, names):
+    movie_id = film["movie_id"]
+    if "name" in film:
+        return film["name"]
+    if movie_id in names:
+        return names[movie_id]
+    return " ".join([r.capitalize() for r in movie_id.split("-") if not r.isdigit()])
+
+
+async def leaderboard_rows(db, threshold, order, skip=0, limit=LEADERBOARD_SIZE):
+    """Ranked films with at least ``threshold`` ratings, names resolved."""
+    top_films = (
+        db.films.find(
+            {"rating_count": {"$gte": threshold}},
+            {"movie_id": 1, "name": 1, "guild_avg": 1, "rating_count": 1, "_id": 0},
         )
-        topf_short.append(
-            f"[{movie_name}](https://letterboxd.com/film/{movie_id}): **{film['guild_avg']:.2f}** ({film['rating_count']})"
+        .sort([("guild_avg", order), ("movie_id", 1)])
+        .skip(skip)
+        .limit(limit)
+    )
+
+    films = await top_films.to_list(length=None)
+    names = get_store().names(film["movie_id"] for film in films if "name" not in film)
+    return [
+        {
+            "movie_id": film["movie_id"],
+            "name": film_name(film, names),
+            "guild_avg": film["guild_avg"],
+            "rating_count": film["rating_count"],
+        }
+        for film in films
+    ]
+
+
+async def refresh_leaderboards(db):
+    """Store the top and bottom films for every threshold in LEADERBOARD_THRESHOLDS.
+
+    Run after the guild's film counters change, so ``<topf`` and ``<lowf``
+    read a single document instead of ranking the films collection.
+    """
+    updated = datetime.utcnow()
+    for threshold in LEADERBOARD_THRESHOLDS:
+        for order in (-1, 1):
+            rows = await leaderboard_rows(db, threshold, order)
+            await db.leaderboards.replace_one(
+                {"_id": f"{threshold}:{order}"},
+                {
+                    "threshold": threshold,
+                    "order": order,
+                    "rows": rows,
+                    "size": len(rows),
+                    "updated": updated,
+                },
+                upsert=True,
+            )
+
+
+class LeaderboardQuery:
+    """Pages of a guild's top or bottom films.
+
+    Reads slices of the stored board when there is one, thresholds
+    without a board, or guilds not synced since, are ranked live.
+    """
+
+    def __init__(self, db, threshold, order):
+        self.db = db
+        self.threshold = threshold
+        self.order = order
+        self.key = f"{threshold}:{order}"
+        self.stored = False
+
+    async def count(self):
+        if self.threshold in LEADERBOARD_THRESHOLDS:
+            board = await self.db.leaderboards.find_one({"_id": self.key}, {"size": 1})
+            if board is not None and "size" in board:
+                self.stored = True
+                return board["size"]
+        films = await self.db.films.count_documents(
+            {"rating_count": {"$gte": self.threshold}}
         )
-        counter += 1
+        return min(films, LEADERBOARD_SIZE)
 
-    return topf_short
+    async def fetch(self, skip, limit):
+        if self.stored:
+            board = await self.db.leaderboards.find_one(
+                {"_id": self.key}, {"rows": {"$slice": [skip, limit]}}
+            )
+            rows = board["rows"] if board else []
+        else:
+            # The live ranking stops where a stored board would
+            limit = min(limit, LEADERBOARD_SIZE - skip)
+            rows = []
+            if limit > 0:
+                rows = await leaderboard_rows(
+                    self.db, self.threshold, self.order, skip, limit
+                )
+        return [
+            f"[{row['name']}](https://letterboxd.com/film/{row['movie_id']}): **{row['guild_avg']:.2f}** ({row['rating_count']})"
+            for row in rows
+        ]
 
 
 def human_count(n):
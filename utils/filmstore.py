@@ -0,0 +1,227 @@
+import json
+import sqlite3
+import time
+
+from utils.cache import TTLCache
+
+# Everything the embeds and leaderboards read from a film, the rest of the
+# API response is dropped before storing
+FILM_FIELDS = (
+    "id",
+    "name",
+    "originalName",
+    "releaseYear",
+    "poster",
+    "links",
+    "genres",
+    "countries",
+    "runTime",
+    "description",
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS films (
+    id TEXT PRIMARY KEY,
+    slug TEXT,
+    name TEXT,
+    year INTEGER,
+    data TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    used_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS films_slug ON films (slug);
+CREATE INDEX IF NOT EXISTS films_used_at ON films (used_at);
+CREATE TABLE IF NOT EXISTS searches (
+    input TEXT PRIMARY KEY,
+    film_id TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    data TEXT
+);
+"""
+
+
+def get_slug(film):
+    for link in film.get("links", []):
+        if link["type"] == "letterboxd":
+            return link["url"].split("/")[-2]
+    return None
+
+
+def slim(details):
+    film = {k: details[k] for k in FILM_FIELDS if k in details}
+    film["contributions"] = [
+        c for c in details.get("contributions", []) if c["type"] == "Director"
+    ]
+    return film
+
+
+class FilmStore:
+    """On-disk film metadata keyed by Letterboxd film id and slug.
+
+    Rows older than ``max_age`` seconds are reported stale so callers
+    refresh them, and ``compact`` trims the table back to ``max_entries``
+    least recently used films. Reads note when a film was used in memory,
+    ``flush_touches`` writes those out in one transaction.
+    """
+
+    def __init__(
+        self,
+        path="films.sqlite3",
+        max_entries=50000,
+        max_age=7 * 24 * 3600,
+        search_age=24 * 3600,
+        memory=1024,
+    ):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.search_age = search_age
+        self.memory = TTLCache(maxsize=memory)
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(SCHEMA)
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(searches)")]
+        if "data" not in columns:
+            # Stores from before searches kept the search's film summary
+            self._conn.execute("ALTER TABLE searches ADD COLUMN data TEXT")
+        self._puts = 0
+        # film id -> last use, written in one go by flush_touches
+        self._touched = {}
+
+    def get(self, film_id, stale=False):
+        """Return the stored film, or None if missing or stale.
+
+        With ``stale=True`` an outdated row is returned rather than None.
+        """
+        film = self.memory.get(film_id)
+        if film is not None:
+            # Hot films are served from memory, trim and warm still need
+            # to see them as recently used
+            self._touched[film_id] = time.time()
+            return film
+        row = self._conn.execute(
+            "SELECT data, fetched_at FROM films WHERE id = ?", (film_id,)
+        ).fetchone()
+        if not row:
+            return None
+        film = json.loads(row[0])
+        if time.time() - row[1] > self.max_age:
+            return film if stale else None
+        self._touched[film_id] = time.time()
+        self.memory.set(film_id, film, self._ttl(row[1]))
+        return film
+
+    def names(self, slugs):
+        """Map slugs to display names for the films we know about."""
+        slugs = list(slugs)
+        names = {}
+        # Stay under SQLite's bound variable limit
+        for i in range(0, len(slugs), 500):
+            chunk = slugs[i : i + 500]  # noqa
+            marks = ",".join("?" * len(chunk))
+            names.update(
+                self._conn.execute(
+                    f"SELECT slug, name FROM films WHERE slug IN ({marks})", chunk
+                ).fetchall()
+            )
+        return names
+
+    def put(self, details):
+        film = slim(details)
+        now = time.time()
+        self.flush_touches()
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO films VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    film["id"],
+                    get_slug(film),
+                    film.get("name"),
+                    film.get("releaseYear"),
+                    json.dumps(film),
+                    now,
+                    now,
+                ),
+            )
+        self.memory.set(film["id"], film, self.max_age)
+        self._puts += 1
+        if self._puts % 1000 == 0:
+            self.trim()
+        return film
+
+    def search(self, keywords):
+        """The film summary a search for ``keywords`` last returned, or None."""
+        row = self._conn.execute(
+            "SELECT data, fetched_at FROM searches WHERE input = ?",
+            (keywords.lower().strip(),),
+        ).fetchone()
+        if not row or not row[0] or time.time() - row[1] > self.search_age:
+            return None
+        return json.loads(row[0])
+
+    def put_search(self, keywords, film):
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO searches VALUES (?, ?, ?, ?)",
+                (keywords.lower().strip(), film["id"], time.time(), json.dumps(film)),
+            )
+
+    def trim(self):
+        """Drop the least recently used films beyond ``max_entries``."""
+        self.flush_touches()
+        with self._conn:
+            cur = self._conn.execute(
+                """DELETE FROM films WHERE id IN (
+                       SELECT id FROM films ORDER BY used_at DESC
+                       LIMIT -1 OFFSET ?)""",
+                (self.max_entries,),
+            )
+        return cur.rowcount
+
+    def compact(self):
+        """Trim, drop expired searches and reclaim the freed disk space."""
+        removed = self.trim()
+        with self._conn:
+            cur = self._conn.execute(
+                "DELETE FROM searches WHERE fetched_at < ?",
+                (time.time() - self.search_age,),
+            )
+        self._conn.execute("VACUUM")
+        self.memory.clear()
+        return removed, cur.rowcount
+
+    def warm(self, limit=None):
+        """Load the most recently used fresh films into memory."""
+        limit = limit or self.memory.maxsize
+        rows = self._conn.execute(
+            """SELECT id, data, fetched_at FROM films WHERE fetched_at > ?
+               ORDER BY used_at DESC LIMIT ?""",
+            (time.time() - self.max_age, limit),
+        ).fetchall()
+        # Oldest first so the most recently used end up at the LRU's hot end
+        for film_id, data, fetched_at in reversed(rows):
+            self.memory.set(film_id, json.loads(data), self._ttl(fetched_at))
+        return len(rows)
+
+    def stats(self):
+        films, searches = self._conn.execute(
+            "SELECT (SELECT COUNT(*) FROM films), (SELECT COUNT(*) FROM searches)"
+        ).fetchone()
+        return {"films": films, "searches": searches, "memory": len(self.memory)}
+
+    def flush_touches(self):
+        """Write the uses recorded by ``get`` in a single transaction."""
+        if not self._touched:
+            return 0
+        touched, self._touched = self._touched, {}
+        with self._conn:
+            self._conn.executemany(
+                "UPDATE films SET used_at = ? WHERE id = ?",
+                [(used_at, film_id) for film_id, used_at in touched.items()],
+            )
+        return len(touched)
+
+    def close(self):
+        self.flush_touches()
+        self._conn.close()
+
+    def _ttl(self, fetched_at):
+        return max(0.0, fetched_at + self.max_age - time.time())
@@ -0,0 +1,209 @@
+import asyncio
+import time
+import traceback
+
+from config import SETTINGS
+from utils import film, mongo, sync
+
+# Syncs running at once across all guilds, each still shares the request
+# scheduler's background lane with the others
+WORKERS = SETTINGS.get('sync', {}).get('workers', 2)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+# Folded into a guild sync or cancelled before it started
+DROPPED = 'dropped'
+
+
+class SyncJob:
+    """A guild sync (uid None) or a single member's sync."""
+
+    def __init__(self, guild, uid=None, label=None, full=False, enqueued=None):
+        self.guild = guild
+        self.uid = uid
+        self.label = label or str(uid or guild)
+        self.full = full
+        self.enqueued = enqueued or time.time()
+        self.state = QUEUED
+        self.progress = sync.SyncProgress()
+        self.done = asyncio.get_event_loop().create_future()
+        self.task = None
+
+    @property
+    def key(self):
+        return (self.guild, self.uid)
+
+    @property
+    def id(self):
+        return f'{self.guild}:{self.uid or ""}'
+
+    def document(self):
+        return {'_id': self.id, 'guild': self.guild, 'uid': self.uid,
+                'label': self.label, 'full': self.full,
+                'enqueued': self.enqueued, 'state': self.state}
+
+
+class SyncManager:
+    """Runs sync jobs on a fixed pool of workers.
+
+    There is at most one job per (guild, member): submitting a duplicate
+    returns the job already queued or running, and a member sync is
+    folded into its guild's sync when one is queued. Queued and running
+    jobs are kept in Mongo so a restart picks them back up, running ones
+    from their sync checkpoint.
+    """
+
+    def __init__(self, workers=WORKERS):
+        self.workers = workers
+        # key -> job, queued and running, in submission order
+        self.jobs = {}
+        self.state = None
+        self._queue = asyncio.Queue()
+        self._workers = []
+        self._stopping = False
+
+    async def start(self):
+        self.state = mongo.global_db().sync_jobs
+        restored = 0
+        async for doc in self.state.find({}).sort('enqueued', 1):
+            job = SyncJob(doc['guild'], doc['uid'], doc['label'], doc['full'],
+                          doc['enqueued'])
+            self.jobs[job.key] = job
+            self._queue.put_nowait(job)
+            restored += 1
+        self._workers = [asyncio.ensure_future(self._worker())
+                         for _ in range(self.workers)]
+        return restored
+
+    async def stop(self):
+        """Stop the workers, leaving unfinished jobs to resume on restart."""
+        self._stopping = True
+        for worker in self._workers:
+            worker.cancel()
+        running = [job.task for job in self.jobs.values() if job.task]
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*self._workers, *running, return_exceptions=True)
+
+    def find(self, guild, uid=None):
+        """The job that already covers syncing (guild, uid), if any."""
+        guild_job = self.jobs.get((guild, None))
+        # A running guild sync read its users when it started, so it only
+        # covers a member followed since while it's still queued
+        if guild_job is not None and (uid is None or guild_job.state == QUEUED):
+            return guild_job
+        return self.jobs.get((guild, uid))
+
+    async def submit(self, guild, uid=None, label=None, full=False):
+        """Queue a sync, returning ``(job, created)``."""
+        job = self.find(guild, uid)
+        if job is not None:
+            return job, False
+
+        job = SyncJob(guild, uid, label, full)
+        if uid is None:
+            # The guild sync covers every member, fold their queued syncs in
+            for other in self.queued(guild):
+                self._drop(other)
+                other.progress = job.progress
+                _chain(job.done, other.done)
+                await self.state.delete_one({'_id': other.id})
+        self.jobs[job.key] = job
+        await self.state.replace_one({'_id': job.id}, job.document(), upsert=True)
+        self._queue.put_nowait(job)
+        return job, True
+
+    async def cancel(self, guild):
+        """Cancel a guild's queued and running jobs, returning how many."""
+        jobs = [job for job in self.jobs.values() if job.guild == guild]
+        for job in jobs:
+            if job.state == RUNNING:
+                # The worker cleans up once the task unwinds
+                job.task.cancel()
+            else:
+                self._drop(job)
+                job.done.cancel()
+                await self.state.delete_one({'_id': job.id})
+        return len(jobs)
+
+    def queued(self, guild=None):
+        return [job for job in self.jobs.values() if job.state == QUEUED
+                and (guild is None or job.guild == guild)]
+
+    def running(self, guild=None):
+        return [job for job in self.jobs.values() if job.state == RUNNING
+                and (guild is None or job.guild == guild)]
+
+    def position(self, job):
+        """1-based place of a queued job in the overall queue."""
+        return self.queued().index(job) + 1
+
+    def _drop(self, job):
+        job.state = DROPPED
+        self.jobs.pop(job.key, None)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            if job.state != QUEUED:
+                continue
+            job.state = RUNNING
+            job.progress.started = time.monotonic()
+            await self.state.update_one({'_id': job.id}, {'$set': {'state': RUNNING}})
+            job.task = asyncio.ensure_future(self._run(job))
+            # wait() rather than await, so a cancelled job doesn't take
+            # the worker down with it
+            await asyncio.wait({job.task})
+            self.jobs.pop(job.key, None)
+            await self.state.delete_one({'_id': job.id})
+            if not job.task.cancelled() and job.task.exception():
+                traceback.print_exception(None, job.task.exception(),
+                                          job.task.exception().__traceback__)
+            _chain(job.task, job.done)
+
+    async def _run(self, job):
+        db = mongo.guild_db(job.guild)
+        checkpoint = sync.Checkpoint(sync.shared_db(db).sync_checkpoints, job.id)
+        try:
+            await checkpoint.load()
+            changed = []
+            if job.uid is None:
+                await sync.sync_guild(db, full=job.full, progress=job.progress,
+                                      checkpoint=checkpoint)
+                changed = [db]
+            else:
+                user = await db.users.find_one({'uid': job.uid})
+                # None if unfollowed while the job was waiting
+                if user is not None:
+                    await sync.sync_user(db, user, full=job.full, progress=job.progress,
+                                         checkpoint=checkpoint)
+                    # A member's ratings count in every guild following them
+                    changed = await sync.member_guilds(db, user['lb_id'])
+            for guild_db in changed:
+                await film.refresh_leaderboards(guild_db)
+        except asyncio.CancelledError:
+            # Only a shutdown keeps the checkpoint, a cancelled sync starts over
+            if not self._stopping:
+                await checkpoint.clear()
+            raise
+        else:
+            await checkpoint.clear()
+        return job.progress
+
+
+def _chain(source, target):
+    """Copy a finished future's outcome onto ``target``, or do so later."""
+    def copy(source):
+        if target.done():
+            return
+        if source.cancelled():
+            target.cancel()
+        elif source.exception() is not None:
+            target.set_exception(source.exception())
+        else:
+            target.set_result(source.result())
+
+    if source.done():
+        copy(source)
+    else:
+        source.add_done_callback(copy)
@@ -0,0 +1,166 @@
+import contextvars
+import urllib.parse
+from collections import Counter
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+
+# Upstream calls made by the command currently running in this task
+_command_calls = contextvars.ContextVar("command_calls", default=None)
+
+
+def endpoint_template(path, letterboxd=True):
+    """Collapse ids out of a path, e.g. ``film/2bbs/statistics`` becomes
+    ``film/{id}/statistics``. Non-API URLs are grouped by host."""
+    if not letterboxd:
+        return urllib.parse.urlsplit(path).netloc or path
+    parts = path.split("/")
+    return "/".join(p if i % 2 == 0 else "{id}" for i, p in enumerate(parts))
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def quantile(self, q):
+        """Estimate a quantile by interpolating inside its bucket."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen, lower = 0, 0.0
+        for bound, n in zip(self.buckets, self.counts):
+            if n and seen + n >= rank:
+                if bound == float("inf"):
+                    return lower
+                return lower + (bound - lower) * (rank - seen) / n
+            seen += n
+            lower = bound
+        return lower
+
+
+class EndpointStats:
+    def __init__(self):
+        self.latency = Histogram()
+        self.statuses = Counter()
+        self.bytes = 0
+        self.retries = 0
+
+
+class CommandStats:
+    def __init__(self):
+        self.invocations = 0
+        self.max_calls = 0
+        self.calls = Histogram(buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, float("inf")))
+        self.endpoints = Counter()
+
+
+class Metrics:
+    def __init__(self):
+        self.endpoints = {}
+        self.commands = {}
+
+    def record(self, template, status, nbytes, latency, retries):
+        stats = self.endpoints.get(template)
+        if stats is None:
+            stats = self.endpoints[template] = EndpointStats()
+        stats.latency.observe(latency)
+        stats.statuses[status] += 1
+        stats.bytes += nbytes
+        stats.retries += retries
+
+        calls = _command_calls.get()
+        if calls is not None:
+            calls[template] += 1
+
+    def start_command(self):
+        return _command_calls.set(Counter())
+
+    def finish_command(self, name, token):
+        calls = _command_calls.get()
+        _command_calls.reset(token)
+        stats = self.commands.get(name)
+        if stats is None:
+            stats = self.commands[name] = CommandStats()
+        stats.invocations += 1
+        stats.max_calls = max(stats.max_calls, sum(calls.values()))
+        stats.calls.observe(sum(calls.values()))
+        stats.endpoints.update(calls)
+
+    def summary(self):
+        """Human readable per-endpoint and per-command tables."""
+        lines = [
+            f"{'endpoint':32} {'calls':>6} {'err':>4} {'p50':>6} {'p95':>6} "
+            f"{'p99':>6} {'retry':>5} {'KiB':>7}"
+        ]
+        for template, stats in sorted(self.endpoints.items()):
+            errors = sum(n for s, n in stats.statuses.items() if s >= 400 or s == 0)
+            p50, p95, p99 = (
+                stats.latency.quantile(q) * 1000 for q in (0.5, 0.95, 0.99)
+            )
+            lines.append(
+                f"{template:32} {stats.latency.count:6} {errors:4} {p50:6.0f} "
+                f"{p95:6.0f} {p99:6.0f} {stats.retries:5} {stats.bytes / 1024:7.0f}"
+            )
+        lines.append("")
+        lines.append(f"{'command':20} {'runs':>6} {'calls/run':>9} {'max':>4}  top endpoints")
+        for name, stats in sorted(self.commands.items()):
+            mean = stats.calls.sum / stats.invocations
+            top = ", ".join(f"{t} {n}" for t, n in stats.endpoints.most_common(3))
+            lines.append(
+                f"{name:20} {stats.invocations:6} {mean:9.1f} "
+                f"{stats.max_calls:4}  {top}"
+            )
+        return "\n".join(lines)
+
+    def export(self):
+        """Prometheus text exposition of everything recorded so far."""
+        lines = []
+        lines.append("# TYPE letterboxd_request_seconds histogram")
+        for template, stats in sorted(self.endpoints.items()):
+            label = f'endpoint="{template}"'
+            cumulative = 0
+            for bound, n in zip(stats.latency.buckets, stats.latency.counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(
+                    f'letterboxd_request_seconds_bucket{{{label},le="{le}"}} {cumulative}'
+                )
+            lines.append(f"letterboxd_request_seconds_sum{{{label}}} {stats.latency.sum}")
+            lines.append(f"letterboxd_request_seconds_count{{{label}}} {stats.latency.count}")
+        lines.append("# TYPE letterboxd_requests_total counter")
+        for template, stats in sorted(self.endpoints.items()):
+            for status, n in sorted(stats.statuses.items()):
+                lines.append(
+                    f'letterboxd_requests_total{{endpoint="{template}",status="{status}"}} {n}'
+                )
+        lines.append("# TYPE letterboxd_response_bytes_total counter")
+        for template, stats in sorted(self.endpoints.items()):
+            lines.append(
+                f'letterboxd_response_bytes_total{{endpoint="{template}"}} {stats.bytes}'
+            )
+        lines.append("# TYPE letterboxd_retries_total counter")
+        for template, stats in sorted(self.endpoints.items()):
+            lines.append(
+                f'letterboxd_retries_total{{endpoint="{template}"}} {stats.retries}'
+            )
+        lines.append("# TYPE command_invocations_total counter")
+        for name, stats in sorted(self.commands.items()):
+            lines.append(f'command_invocations_total{{command="{name}"}} {stats.invocations}')
+        lines.append("# TYPE command_upstream_calls_total counter")
+        for name, stats in sorted(self.commands.items()):
+            for template, n in sorted(stats.endpoints.items()):
+                lines.append(
+                    f'command_upstream_calls_total{{command="{name}",endpoint="{template}"}} {n}'
+                )
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,57 @@
+import motor.motor_asyncio as motor
+
+from config import conn_url, SETTINGS
+
+# Database shared by every guild: ratings keyed by Letterboxd user, the
+# members collection of everyone followed in at least one guild, and
+# bot-wide state like the sync queue
+GLOBAL_DB = SETTINGS.get('global_db', 'lbx')
+
+_client = None
+
+
+def get_conn_url(db_name=GLOBAL_DB):
+    return conn_url + db_name + '?retryWrites=true&w=majority'
+
+
+def create_client(max_pool_size=50, min_pool_size=0, max_idle=300, timeout=30):
+    # One client for the process: every guild's database is a handle on
+    # the same connection pool and server monitor
+    return motor.AsyncIOMotorClient(
+        get_conn_url(),
+        maxPoolSize=max_pool_size,
+        minPoolSize=min_pool_size,
+        maxIdleTimeMS=max_idle * 1000,
+        serverSelectionTimeoutMS=timeout * 1000)
+
+
+def set_client(client):
+    global _client
+    _client = client
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = create_client(**SETTINGS.get('mongo', {}))
+    return _client
+
+
+def close_client():
+    global _client
+    if _client is not None:
+        _client.close()
+    _client = None
+
+
+def guild_db(guild_id):
+    return get_client()[f'g{guild_id}']
+
+
+def guild_id(db):
+    """The Discord guild id of a guild_db handle, as the request scheduler keys it."""
+    return int(db.name[1:])
+
+
+def global_db():
+    return get_client()[GLOBAL_DB]
@@ -0,0 +1,53 @@
+import math
+from collections import OrderedDict
+
+from discord.ext import menus
+
+# Pages each open menu keeps, enough to flip back and forth without a query
+CACHED_PAGES = 5
+
+
+class ListQuery:
+    """Query over rows that are already in memory."""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    async def count(self):
+        return len(self.rows)
+
+    async def fetch(self, skip, limit):
+        return self.rows[skip : skip + limit]  # noqa
+
+
+class QuerySource(menus.PageSource):
+    """Page source that reads each page from a query when it's shown.
+
+    ``query`` has async ``count()`` and ``fetch(skip, limit)`` methods,
+    the count is read once when the menu starts.
+    """
+
+    def __init__(self, query, per_page=20):
+        self.query = query
+        self.per_page = per_page
+        self.total = 0
+        self._pages = OrderedDict()
+
+    async def prepare(self):
+        self.total = await self.query.count()
+
+    def is_paginating(self):
+        return self.total > self.per_page
+
+    def get_max_pages(self):
+        return max(1, math.ceil(self.total / self.per_page))
+
+    async def get_page(self, page_number):
+        if page_number in self._pages:
+            self._pages.move_to_end(page_number)
+            return self._pages[page_number]
+        entries = await self.query.fetch(page_number * self.per_page, self.per_page)
+        self._pages[page_number] = entries
+        while len(self._pages) > CACHED_PAGES:
+            self._pages.popitem(last=False)
+        return entries
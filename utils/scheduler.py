@@ -0,0 +1,129 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+INTERACTIVE = 0
+BACKGROUND = 1
+LANES = {INTERACTIVE: 'interactive', BACKGROUND: 'background'}
+
+
+class LaneStats:
+    def __init__(self):
+        self.served = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait):
+        self.served += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+
+class _Slot:
+    def __init__(self, scheduler, lane, guild):
+        self.scheduler = scheduler
+        self.lane = lane
+        self.guild = guild
+
+    async def __aenter__(self):
+        await self.scheduler.acquire(self.lane, self.guild)
+
+    async def __aexit__(self, *exc):
+        self.scheduler.release()
+
+
+class RequestScheduler:
+    """Hands out a fixed number of upstream request slots.
+
+    Waiting interactive requests are always served before background
+    ones. Inside a lane, guilds take turns so one guild's bulk sync
+    can't hold up everyone else queued in the same lane.
+    """
+
+    def __init__(self, concurrency=8):
+        self.concurrency = concurrency
+        self._active = 0
+        # lane -> OrderedDict(guild -> deque of (future, enqueued_at))
+        self._lanes = {lane: OrderedDict() for lane in LANES}
+        self.lane_stats = {lane: LaneStats() for lane in LANES}
+
+    def slot(self, lane=INTERACTIVE, guild=None):
+        return _Slot(self, lane, guild)
+
+    def depth(self, lane):
+        return sum(len(waiters) for waiters in self._lanes[lane].values())
+
+    async def acquire(self, lane=INTERACTIVE, guild=None):
+        if self._active < self.concurrency and not any(self._lanes.values()):
+            self._active += 1
+            self.lane_stats[lane].record(0.0)
+            return
+
+        entry = (asyncio.get_event_loop().create_future(), time.monotonic())
+        queues = self._lanes[lane]
+        queues.setdefault(guild, deque()).append(entry)
+        try:
+            await entry[0]
+        except asyncio.CancelledError:
+            if entry[0].done() and not entry[0].cancelled():
+                # Granted a slot just as we were cancelled, hand it on
+                self.release()
+            else:
+                self._discard(lane, guild, entry)
+            raise
+
+    def release(self):
+        self._active -= 1
+        self._dispatch()
+
+    def _discard(self, lane, guild, entry):
+        waiters = self._lanes[lane].get(guild)
+        if waiters is None:
+            return
+        try:
+            waiters.remove(entry)
+        except ValueError:
+            pass
+        if not waiters:
+            del self._lanes[lane][guild]
+
+    def _dispatch(self):
+        while self._active < self.concurrency:
+            lane, entry = self._next_waiter()
+            if entry is None:
+                return
+            future, enqueued_at = entry
+            if future.done():
+                continue
+            self._active += 1
+            self.lane_stats[lane].record(time.monotonic() - enqueued_at)
+            future.set_result(None)
+
+    def _next_waiter(self):
+        for lane in sorted(self._lanes):
+            queues = self._lanes[lane]
+            if not queues:
+                continue
+            guild, waiters = next(iter(queues.items()))
+            entry = waiters.popleft()
+            if waiters:
+                # Round robin: this guild goes to the back of the line
+                queues.move_to_end(guild)
+            else:
+                del queues[guild]
+            return lane, entry
+        return None, None
+
+    def stats(self):
+        stats = {'active': self._active, 'concurrency': self.concurrency}
+        for lane, name in LANES.items():
+            lane_stats = self.lane_stats[lane]
+            served = lane_stats.served
+            stats[name] = {
+                'depth': self.depth(lane),
+                'guilds_waiting': len(self._lanes[lane]),
+                'served': served,
+                'mean_wait': lane_stats.total_wait / served if served else 0.0,
+                'max_wait': lane_stats.max_wait,
+            }
+        return stats
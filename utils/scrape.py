@@ -0,0 +1,97 @@
+import concurrent.futures
+import multiprocessing
+import os
+
+from lxml import html
+
+# Match a whole class token, so "film-poster" doesn't also hit "film-poster-123"
+POSTERS = html.etree.XPath(
+    '//li[contains(concat(" ", normalize-space(@class), " "), " poster-container ")]'
+)
+TARGET_LINK = html.etree.XPath(
+    './/div[contains(concat(" ", normalize-space(@class), " "), " film-poster ")]'
+    "/@data-target-link"
+)
+RATING_CLASS = html.etree.XPath(
+    './/span[contains(concat(" ", normalize-space(@class), " "), " rating ")]/@class'
+)
+PAGINATION = html.etree.XPath(
+    '//li[contains(concat(" ", normalize-space(@class), " "), " paginate-page ")]'
+)
+
+# forkserver isn't available on Windows
+START_METHOD = (
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+_pool = None
+
+
+def parse_ratings_page(body, return_unrated=False):
+    """Return (movie_id, rating_id) pairs from a films/by/date page.
+
+    Unrated films get rating_id -1, and are skipped unless
+    ``return_unrated`` is set.
+    """
+    if not body:
+        return []
+    return _ratings(html.fromstring(body), return_unrated)
+
+
+def parse_first_page(body, return_unrated=False):
+    """Page count and ratings of a user's first page, from one parse."""
+    if not body:
+        return 1, []
+    tree = html.fromstring(body)
+    return _page_count(tree), _ratings(tree, return_unrated)
+
+
+def _ratings(tree, return_unrated):
+    ratings = []
+    for poster in POSTERS(tree):
+        link = TARGET_LINK(poster)
+        if not link:
+            continue
+        movie_id = link[0].split("/")[-2]
+
+        rating_class = RATING_CLASS(poster)
+        if rating_class:
+            rating_id = int(rating_class[0].split()[-1].split("-")[-1])
+        elif return_unrated:
+            rating_id = -1
+        else:
+            continue
+        ratings.append((movie_id, rating_id))
+    return ratings
+
+
+def _page_count(tree):
+    body_class = tree.xpath("/html/body/@class")
+    if body_class and "error" in body_class[0].split():
+        return -1
+    pages = PAGINATION(tree)
+    if not pages:
+        return 1
+    return int(pages[-1].text_content().strip().replace(",", ""))
+
+
+def get_pool():
+    """Process pool for parsing, shared for the life of the process.
+
+    Workers start from a forkserver rather than a fork of the caller, whose
+    Motor and aiohttp threads could leave a forked child deadlocked. Entry
+    points create the pool at startup and need a ``__main__`` guard.
+    """
+    global _pool
+    if _pool is None:
+        _pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=os.cpu_count(), mp_context=multiprocessing.get_context(START_METHOD)
+        )
+    return _pool
+
+
+def close_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
@@ -0,0 +1,889 @@
+import asyncio
+import contextlib
+import os
+import time
+import weakref
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import pymongo
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from config import SETTINGS
+from utils import api, scrape
+from utils.mongo import GLOBAL_DB, guild_id
+
+# Pages fetched at once across all users, and ratings per Mongo bulk write
+CONCURRENCY = SETTINGS.get('sync', {}).get('concurrency', 8)
+WRITE_BATCH = SETTINGS.get('sync', {}).get('write_batch', 1000)
+# Pages parsed at once, one per process in utils.scrape's pool
+PARSE_WORKERS = os.cpu_count()
+# Incremental syncs only read a user's newest pages, so every so often
+# re-read everything to pick up edits to old ratings
+FULL_SYNC_INTERVAL = timedelta(days=SETTINGS.get('sync', {}).get('full_sync_days', 7))
+
+# A guild sync skips members another guild's sync read this recently
+FRESH_FOR = timedelta(minutes=SETTINGS.get('sync', {}).get('fresh_minutes', 30))
+# Resume an interrupted sync from its checkpoint only within this long
+CHECKPOINT_MAX_AGE = timedelta(hours=6)
+
+# Running per-film counters in each guild's films collection
+COUNTERS = ('sum', 'rating_count', 'unrated_count')
+
+RATINGS_URL = 'https://letterboxd.com/{}/films/by/date/page/{}/'
+
+
+class SyncProgress:
+    """Live counters for one sync, safe to read while it runs."""
+
+    def __init__(self):
+        self.users_total = 0
+        self.users_done = 0
+        self.pages_total = 0
+        self.pages_done = 0
+        # Rating documents written, only counting real changes
+        self.inserted = 0
+        self.updated = 0
+        self.deleted = 0
+        self.started = time.monotonic()
+        self.finished = None
+
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    def pages_per_second(self):
+        elapsed = self.elapsed()
+        return self.pages_done / elapsed if elapsed else 0.0
+
+    def eta(self):
+        """Seconds left at the current rate, None until there is a rate.
+
+        Incremental users usually stop early, so this errs on the long side.
+        """
+        rate = self.pages_per_second()
+        if not rate:
+            return None
+        return max(0, self.pages_total - self.pages_done) / rate
+
+    def __str__(self):
+        text = (f'{self.users_done}/{self.users_total} users, '
+                f'{self.pages_done}/{self.pages_total} pages, '
+                f'{self.pages_per_second():.1f} pages/s')
+        eta = self.eta()
+        if self.finished is None and eta is not None:
+            text += f', ~{eta:.0f}s left'
+        if self.inserted or self.updated or self.deleted:
+            text += (f'; ratings {self.inserted} added, {self.updated} changed, '
+                     f'{self.deleted} removed')
+        return text
+
+    def count_writes(self, inserted, updated):
+        self.inserted += inserted
+        self.updated += updated
+
+
+def shared_db(db):
+    """The global database on the same client as a guild's database."""
+    return db.client[GLOBAL_DB]
+
+
+async def fetch(url, guild=None):
+    return await api.api_call(url, letterboxd=False, is_json=False,
+                              priority=api.BACKGROUND, guild=guild)
+
+
+def rating_operation(lb_id, movie_id, rating_id, send_to_db=True):
+    if rating_id != -1 and lb_id in ['hizv', 'ketchupin']:
+        rating_id *= 1.25
+
+    rating_object = {
+                'movie_id': movie_id,
+                'rating_id': rating_id,
+                'lb_id': lb_id
+            }
+
+    # If returning objects, just return the object
+    if not send_to_db:
+        return rating_object
+    # Otherwise return an UpdateOne operation to bulk execute
+    return UpdateOne({
+            'lb_id': lb_id,
+            'movie_id': movie_id
+        },
+        {
+            '$set': rating_object
+        }, upsert=True)
+
+
+async def parse_page(body, first=False):
+    # Parse the ratings page in the process pool, straight from the raw bytes.
+    # A first page also yields the page count: (num_pages, ratings)
+    loop = asyncio.get_event_loop()
+    parse = scrape.parse_first_page if first else scrape.parse_ratings_page
+    return await loop.run_in_executor(scrape.get_pool(), parse, body, True)
+
+
+def api_ratings_operations(page, lb_id, lid, send_to_db=True, return_unrated=False):
+    # Same documents as the scraped sync, from one page of the films API
+    operations = []
+    for film in page:
+        movie_id = None
+        for link in film['links']:
+            if link['type'] == 'letterboxd':
+                movie_id = link['url'].split('/')[-2]
+        if not movie_id:
+            continue
+
+        rating_id = -1
+        for relationship in film.get('relationships', []):
+            if relationship['member']['id'] == lid and 'rating' in relationship['relationship']:
+                # The API rates 0.5-5 stars, the site's rated-N classes go 1-10
+                rating_id = int(round(relationship['relationship']['rating'] * 2))
+        if rating_id == -1 and not return_unrated:
+            continue
+
+        operations.append(rating_operation(lb_id, movie_id, rating_id, send_to_db))
+
+    return operations
+
+
+async def get_user_ratings_api(shared, lb_id, lid, return_unrated=False, progress=None, guild=None):
+    films_request = {
+        'member': lid,
+        'memberRelationship': 'Watched',
+    }
+
+    # Every film the user has watched, to find the ones since un-logged
+    seen = set()
+
+    # Films stream in pages of 100, write each page as soon as it's complete
+    async def flush(page):
+        ratings = api_ratings_operations(page, lb_id, lid, False, True)
+        seen.update(rating['movie_id'] for rating in ratings)
+        ratings = [rating for rating in ratings if return_unrated or rating['rating_id'] != -1]
+        writes = await write_ratings(shared, ratings)
+        if progress:
+            progress.pages_done += 1
+            progress.count_writes(*writes)
+
+    page = []
+    async for film in api.paginate('films', films_request,
+                                   priority=api.BACKGROUND, guild=guild):
+        page.append(film)
+        if len(page) == 100:
+            await flush(page)
+            page = []
+    await flush(page)
+
+    deleted = await delete_missing(shared, lb_id, seen)
+    if progress:
+        progress.deleted += deleted
+
+
+async def get_ratings_api(shared, users, return_unrated=True, progress=None, guild=None):
+    if progress:
+        progress.users_total += len(users)
+    for user in users:
+        await get_user_ratings_api(shared, user['lb_id'], user['lid'],
+                                   return_unrated=return_unrated, progress=progress,
+                                   guild=guild)
+        if progress:
+            progress.users_done += 1
+
+
+class Checkpoint:
+    """What an interrupted sync already wrote, saved as it goes.
+
+    Finished users are skipped when the sync resumes, and users part way
+    through a full read only fetch the pages they are missing. Pages move
+    as users log films, so checkpoints older than CHECKPOINT_MAX_AGE are
+    ignored rather than trusted.
+    """
+
+    def __init__(self, collection, key):
+        self.collection = collection
+        self.key = key
+        self.users = set()
+        # lb_id -> page numbers written, and page count and movie_ids of page 1
+        self.pages = {}
+        self.first = {}
+
+    async def load(self):
+        doc = await self.collection.find_one({'_id': self.key})
+        if doc and datetime.utcnow() - doc['created'] < CHECKPOINT_MAX_AGE:
+            self.users = set(doc.get('users', []))
+            self.pages = {lb_id: set(pages) for lb_id, pages in doc.get('pages', {}).items()}
+            self.first = doc.get('first', {})
+        else:
+            await self.clear()
+        await self.collection.update_one({'_id': self.key},
+                                         {'$setOnInsert': {'created': datetime.utcnow()}},
+                                         upsert=True)
+        return self
+
+    async def pages_written(self, pages, first):
+        """Record pages whose ratings are written, ``{lb_id: [page, ...]}``."""
+        update = {}
+        if pages:
+            update['$addToSet'] = {f'pages.{lb_id}': {'$each': numbers}
+                                   for lb_id, numbers in pages.items()}
+        if first:
+            update['$set'] = {f'first.{lb_id}': page for lb_id, page in first.items()}
+        if update:
+            await self.collection.update_one({'_id': self.key}, update)
+        for lb_id, numbers in pages.items():
+            self.pages.setdefault(lb_id, set()).update(numbers)
+        self.first.update(first)
+
+    async def user_done(self, lb_id):
+        self.users.add(lb_id)
+        await self.collection.update_one({'_id': self.key}, {
+            '$addToSet': {'users': lb_id},
+            '$unset': {f'pages.{lb_id}': '', f'first.{lb_id}': ''},
+        })
+
+    async def clear(self):
+        await self.collection.delete_one({'_id': self.key})
+
+
+async def get_ratings(shared, lb_ids, return_unrated=True, full=False, progress=None, guild=None,
+                      checkpoint=None):
+    # Pages of every user stream through fetch -> parse -> write stages.
+    # Bounded queues between them keep memory flat however many users and
+    # pages there are, and let one user's parsing overlap the next one's fetching.
+    # A user is finished as soon as their last page is written, which is
+    # also when the checkpoint marks them done.
+    progress = progress or SyncProgress()
+    if checkpoint:
+        resumed = [lb_id for lb_id in lb_ids if lb_id in checkpoint.users]
+        progress.users_total += len(resumed)
+        progress.users_done += len(resumed)
+        lb_ids = [lb_id for lb_id in lb_ids if lb_id not in checkpoint.users]
+    progress.users_total += len(lb_ids)
+    loop = asyncio.get_event_loop()
+
+    user_docs = {user['lb_id']: user
+                 async for user in shared.members.find({'lb_id': {'$in': lb_ids}})}
+    # Each user's first page gives their real page count, until then the
+    # progress estimate uses the count the last sync saw
+    estimates = {lb_id: max(user_docs.get(lb_id, {}).get('num_ratings_pages', 1), 1)
+                 for lb_id in lb_ids}
+    progress.pages_total += sum(estimates.values())
+    page_counts = {}
+
+    # films/by/date lists newest first, so users with a recent full sync
+    # only need pages until one overlaps what the last sync saw first
+    marks = {}
+    if not full:
+        for lb_id, user in user_docs.items():
+            mark = user.get('sync_mark')
+            if mark and datetime.utcnow() - mark['full_synced_at'] < FULL_SYNC_INTERVAL:
+                marks[lb_id] = set(mark['movie_ids'])
+    newest, failed = {}, set()
+    # Every film on each user's pages, and the users whose pages were all
+    # read this run, which are the only ones safe to check for deleted ratings
+    snapshots = {lb_id: set() for lb_id in lb_ids}
+    complete = set()
+
+    pages = asyncio.Queue(CONCURRENCY)
+    responses = asyncio.Queue(CONCURRENCY + PARSE_WORKERS)
+    operations = asyncio.Queue(CONCURRENCY)
+    active_users = asyncio.Semaphore(CONCURRENCY)
+    # Pages of each user queued but not yet written or given up on
+    pending = defaultdict(int)
+    feeding, finished = set(), set()
+    # Ratings waiting for the next bulk write, and the pages they came from
+    batch, batch_pages = [], []
+    unflushed = defaultdict(int)
+
+    async def settle(lb_id, count=1):
+        pending[lb_id] -= count
+        await maybe_finish(lb_id)
+
+    async def maybe_finish(lb_id):
+        if lb_id in feeding or pending[lb_id] or lb_id in finished:
+            return
+        finished.add(lb_id)
+        movie_ids = snapshots.pop(lb_id)
+        if lb_id not in failed:
+            if lb_id in complete:
+                progress.deleted += await delete_missing(shared, lb_id, movie_ids)
+            if lb_id in newest:
+                # Move the watermark up to what the first page shows now
+                now = datetime.utcnow()
+                mark = {'sync_mark.movie_ids': list(newest[lb_id]), 'sync_mark.synced_at': now,
+                        'num_ratings_pages': page_counts[lb_id]}
+                if lb_id not in marks:
+                    mark['sync_mark.full_synced_at'] = now
+                await shared.members.update_one({'lb_id': lb_id}, {'$set': mark})
+            if checkpoint:
+                await checkpoint.user_done(lb_id)
+        # Users with a failed page keep the old watermark so the gap is retried
+        progress.users_done += 1
+
+    async def resume(lb_id):
+        # Finish a full read the checkpoint has part of
+        first = checkpoint.first[lb_id]
+        written = checkpoint.pages.get(lb_id, set())
+        num_pages = page_counts[lb_id] = first['pages']
+        newest[lb_id] = set(first['movie_ids'])
+        progress.pages_total += num_pages - estimates[lb_id]
+        progress.pages_done += len(written)
+        for page in range(1, num_pages + 1):
+            if page not in written:
+                pending[lb_id] += 1
+                await pages.put((lb_id, page, None))
+
+    async def feed(lb_id):
+        async with active_users:
+            feeding.add(lb_id)
+            mark = marks.get(lb_id)
+            if mark is None and checkpoint and lb_id in checkpoint.first:
+                await resume(lb_id)
+                feeding.discard(lb_id)
+                await finish_feed(lb_id)
+                return
+
+            # Page 1 is also where the page count comes from, the rest
+            # are queued as soon as it has been parsed
+            pending[lb_id] += 1
+            seen = loop.create_future()
+            await pages.put((lb_id, 1, seen))
+            movie_ids = await seen
+            num_pages = max(page_counts.get(lb_id, 1), 1)
+            progress.pages_total += num_pages - estimates[lb_id]
+            if movie_ids is not None and not (mark and movie_ids & mark):
+                for page in range(2, num_pages + 1):
+                    pending[lb_id] += 1
+                    if mark is None:
+                        await pages.put((lb_id, page, None))
+                        continue
+                    # Incremental: wait for each page before asking for the next
+                    seen = loop.create_future()
+                    await pages.put((lb_id, page, seen))
+                    movie_ids = await seen
+                    if movie_ids is None or movie_ids & mark:
+                        progress.pages_total -= num_pages - page
+                        break
+                else:
+                    complete.add(lb_id)
+            else:
+                progress.pages_total -= num_pages - 1
+                if num_pages == 1 and movie_ids is not None:
+                    complete.add(lb_id)
+            feeding.discard(lb_id)
+            await finish_feed(lb_id)
+
+    async def finish_feed(lb_id):
+        # Don't leave a user's last pages waiting on other users' ratings
+        # to fill the batch
+        if pending[lb_id] and pending[lb_id] == unflushed[lb_id]:
+            await flush()
+        else:
+            await maybe_finish(lb_id)
+
+    async def fetch_pages():
+        while True:
+            lb_id, page, seen = await pages.get()
+            try:
+                response = await fetch(RATINGS_URL.format(lb_id, page), guild)
+                await responses.put((response, {'lb_id': lb_id, 'page': page, 'seen': seen}))
+            except api.LetterboxdError as e:
+                print(e)
+                failed.add(lb_id)
+                progress.pages_done += 1
+                if seen:
+                    seen.set_result(None)
+                await settle(lb_id)
+            finally:
+                pages.task_done()
+
+    async def parse_pages():
+        while True:
+            response, meta = await responses.get()
+            lb_id, seen = meta['lb_id'], meta['seen']
+            try:
+                if meta['page'] == 1:
+                    num_pages, ratings = await parse_page(response, first=True)
+                    if num_pages == -1:
+                        # An error page rather than an empty profile
+                        raise ValueError('error page')
+                    page_counts[lb_id] = num_pages
+                else:
+                    ratings = await parse_page(response)
+                movie_ids = {movie_id for movie_id, _ in ratings}
+                snapshots[lb_id] |= movie_ids
+                if meta['page'] == 1:
+                    newest[lb_id] = movie_ids
+                progress.pages_done += 1
+                if seen:
+                    seen.set_result(movie_ids)
+                await operations.put((lb_id, meta['page'],
+                                      [rating_operation(lb_id, movie_id, rating_id, False)
+                                       for movie_id, rating_id in ratings
+                                       if return_unrated or rating_id != -1]))
+            except Exception as e:
+                print(lb_id, meta['page'], e)
+                failed.add(lb_id)
+                progress.pages_done += 1
+                if seen and not seen.done():
+                    seen.set_result(None)
+                await settle(lb_id)
+            finally:
+                responses.task_done()
+
+    async def flush():
+        nonlocal batch, batch_pages, unflushed
+        ratings, batch = batch, []
+        written, batch_pages = batch_pages, []
+        unflushed = defaultdict(int)
+        if not written:
+            return
+        progress.count_writes(*await write_ratings(shared, ratings))
+
+        by_user = defaultdict(list)
+        for lb_id, page in written:
+            by_user[lb_id].append(page)
+        if checkpoint:
+            first = {lb_id: {'pages': page_counts[lb_id], 'movie_ids': list(newest[lb_id])}
+                     for lb_id, numbers in by_user.items() if 1 in numbers}
+            await checkpoint.pages_written(by_user, first)
+        for lb_id, numbers in by_user.items():
+            await settle(lb_id, len(numbers))
+        # Last pages that arrived while this write was in flight
+        if any(lb_id not in feeding and pending[lb_id] == count
+               for lb_id, count in unflushed.items() if count):
+            await flush()
+
+    async def write_batches():
+        while True:
+            lb_id, page, ratings = await operations.get()
+            try:
+                batch.extend(ratings)
+                batch_pages.append((lb_id, page))
+                unflushed[lb_id] += 1
+                last_page = lb_id not in feeding and pending[lb_id] == unflushed[lb_id]
+                if len(batch) >= WRITE_BATCH or last_page:
+                    await flush()
+            finally:
+                operations.task_done()
+
+    async def drain():
+        await asyncio.gather(*(feed(lb_id) for lb_id in lb_ids))
+        await pages.join()
+        await responses.join()
+        await operations.join()
+        await flush()
+
+    workers = [asyncio.ensure_future(fetch_pages()) for _ in range(CONCURRENCY)]
+    workers += [asyncio.ensure_future(parse_pages()) for _ in range(PARSE_WORKERS)]
+    workers.append(asyncio.ensure_future(write_batches()))
+    main = asyncio.ensure_future(drain())
+    try:
+        # Workers only stop by raising, and a dead stage would leave the
+        # queues in front of it full and the feeders waiting for good, so
+        # the first error from any of them fails the whole sync
+        done, _ = await asyncio.wait([main, *workers], return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            task.result()
+    finally:
+        for task in [main, *workers]:
+            task.cancel()
+        await asyncio.gather(main, *workers, return_exceptions=True)
+
+
+def rating_delta(before, after):
+    """(sum, rated, unrated) change from replacing rating ``before`` with
+    ``after``, either of which is None for no rating document."""
+    def counts(rating_id):
+        if rating_id is None:
+            return (0, 0, 0)
+        if rating_id == -1:
+            return (0, 0, 1)
+        return (rating_id, 1, 0)
+
+    return tuple(new - old for new, old in zip(counts(after), counts(before)))
+
+
+def counter_update(d_sum, d_rated, d_unrated):
+    # Pipeline update, so the average is derived from the new counters in
+    # the same atomic write that moves them
+    return [
+        {'$set': {
+            'sum': {'$add': [{'$ifNull': ['$sum', 0]}, d_sum]},
+            'rating_count': {'$add': [{'$ifNull': ['$rating_count', 0]}, d_rated]},
+            'unrated_count': {'$add': [{'$ifNull': ['$unrated_count', 0]}, d_unrated]},
+        }},
+        {'$set': {
+            'guild_avg': {'$cond': [
+                {'$gt': ['$rating_count', 0]},
+                {'$divide': ['$sum', '$rating_count']},
+                0,
+            ]},
+            'watch_count': {'$add': ['$rating_count', '$unrated_count']},
+        }},
+    ]
+
+
+# lb_id -> lock held while a member's ratings or guild list change along
+# with the film counters they feed. Without it a rating written between a
+# guild being added to the member and their ratings being counted into it
+# would be counted twice. Per process: syncs run in the bot's job manager
+_member_locks = weakref.WeakValueDictionary()
+
+
+@contextlib.asynccontextmanager
+async def member_locks(lb_ids):
+    """Hold the locks of several members, always taken in sorted order."""
+    locks = []
+    for lb_id in sorted(set(lb_ids)):
+        lock = _member_locks.get(lb_id)
+        if lock is None:
+            lock = _member_locks[lb_id] = asyncio.Lock()
+        locks.append(lock)
+    async with contextlib.AsyncExitStack() as stack:
+        for lock in locks:
+            await stack.enter_async_context(lock)
+        yield
+
+
+async def update_film_counters(shared, changes, guilds=None):
+    """Apply (lb_id, movie_id, before, after) rating changes to the film
+    counters of every guild following each user, or of ``guilds`` only."""
+    if guilds is None:
+        lb_ids = list({lb_id for lb_id, _, _, _ in changes})
+        following = {member['lb_id']: member.get('guilds', [])
+                     async for member in shared.members.find({'lb_id': {'$in': lb_ids}},
+                                                             {'lb_id': 1, 'guilds': 1})}
+
+    totals = defaultdict(lambda: [0, 0, 0])
+    for lb_id, movie_id, before, after in changes:
+        delta = rating_delta(before, after)
+        for guild in following.get(lb_id, []) if guilds is None else guilds:
+            total = totals[(guild, movie_id)]
+            for i, d in enumerate(delta):
+                total[i] += d
+
+    by_guild = defaultdict(list)
+    for (guild, movie_id), delta in totals.items():
+        if any(delta):
+            by_guild[guild].append(UpdateOne({'movie_id': movie_id}, counter_update(*delta),
+                                              upsert=True))
+    for guild, operations in by_guild.items():
+        await shared.client[guild].films.bulk_write(operations, ordered=False)
+
+
+async def write_ratings(shared, ratings, attempts=3):
+    """Upsert rating documents and move the film counters they affect.
+
+    Each write is conditional on the rating read just before it, so a
+    concurrent sync of the same user makes it fail instead of counting a
+    change twice; failed writes are re-read and retried. Unchanged
+    ratings aren't written. Returns how many were (inserted, updated).
+    """
+    async with member_locks(rating['lb_id'] for rating in ratings):
+        return await _write_ratings(shared, ratings, attempts)
+
+
+async def _write_ratings(shared, ratings, attempts):
+    inserted = updated = 0
+    for _ in range(attempts):
+        if not ratings:
+            break
+        wanted = defaultdict(list)
+        for rating in ratings:
+            wanted[rating['lb_id']].append(rating['movie_id'])
+        current = {(rating['lb_id'], rating['movie_id']): rating['rating_id']
+                   async for rating in shared.ratings.find(
+                       {'$or': [{'lb_id': lb_id, 'movie_id': {'$in': movie_ids}}
+                                for lb_id, movie_ids in wanted.items()]},
+                       {'_id': 0, 'lb_id': 1, 'movie_id': 1, 'rating_id': 1})}
+
+        operations, changes = [], []
+        for rating in ratings:
+            lb_id, movie_id = rating['lb_id'], rating['movie_id']
+            before = current.get((lb_id, movie_id))
+            if before == rating['rating_id']:
+                continue
+            condition = {'$exists': False} if before is None else before
+            operations.append(UpdateOne({'lb_id': lb_id, 'movie_id': movie_id, 'rating_id': condition},
+                                        {'$set': rating}, upsert=True))
+            changes.append((lb_id, movie_id, before, rating['rating_id']))
+        if not operations:
+            ratings = []
+            break
+
+        failed = set()
+        try:
+            await shared.ratings.bulk_write(operations, ordered=False)
+        except BulkWriteError as bwe:
+            # A rating that moved since it was read no longer matches, and
+            # the upsert then collides with it on the unique index
+            failed = {error['index'] for error in bwe.details['writeErrors']}
+        applied = [change for i, change in enumerate(changes) if i not in failed]
+        await update_film_counters(shared, applied)
+        for _, _, before, _ in applied:
+            if before is None:
+                inserted += 1
+            else:
+                updated += 1
+        ratings = [{'lb_id': lb_id, 'movie_id': movie_id, 'rating_id': after}
+                   for i, (lb_id, movie_id, _, after) in enumerate(changes) if i in failed]
+    if ratings:
+        print(f'Gave up writing {len(ratings)} ratings after {attempts} attempts')
+    return inserted, updated
+
+
+async def delete_missing(shared, lb_id, seen):
+    """Delete a user's stored ratings for films outside ``seen``, a full
+    read of every film they've logged. Returns how many were deleted."""
+    stored = await shared.ratings.distinct('movie_id', {'lb_id': lb_id})
+    if stored and not seen:
+        # More likely a page the parser didn't recognise (new markup, a
+        # private profile) than a user who un-logged everything
+        print(f'Not deleting {len(stored)} ratings of {lb_id}, their pages showed no films')
+        return 0
+    changes = []
+    async with member_locks([lb_id]):
+        for movie_id in stored:
+            if movie_id in seen:
+                continue
+            # One at a time, to learn exactly which rating each delete removed
+            rating = await shared.ratings.find_one_and_delete({'lb_id': lb_id, 'movie_id': movie_id})
+            if rating is not None:
+                changes.append((lb_id, movie_id, rating['rating_id'], None))
+        await update_film_counters(shared, changes)
+    return len(changes)
+
+
+async def move_member_ratings(shared, guild, lb_id, joining):
+    """Add a user's stored ratings to one guild's film counters when they
+    join it, or take them out when they leave."""
+    changes = []
+    async for rating in shared.ratings.find({'lb_id': lb_id}, {'movie_id': 1, 'rating_id': 1}):
+        before, after = (None, rating['rating_id']) if joining else (rating['rating_id'], None)
+        changes.append((lb_id, rating['movie_id'], before, after))
+        if len(changes) >= WRITE_BATCH:
+            await update_film_counters(shared, changes, [guild])
+            changes = []
+    if changes:
+        await update_film_counters(shared, changes, [guild])
+
+
+async def ensure_indexes(db):
+    # Rating upserts look up (lb_id, movie_id), the averages match on
+    # lb_id and group by movie_id, and $merge needs a unique index on the
+    # field it matches films on. Leaderboards range over rating_count and
+    # rank by guild_avg
+    shared = shared_db(db)
+    await shared.ratings.create_index([('lb_id', pymongo.ASCENDING), ('movie_id', pymongo.ASCENDING)],
+                                      unique=True)
+    await shared.ratings.create_index('movie_id')
+    await shared.members.create_index('lb_id', unique=True)
+    await shared.members.create_index('guilds')
+    await shared.sync_checkpoints.create_index(
+        'created', expireAfterSeconds=int(CHECKPOINT_MAX_AGE.total_seconds()))
+    await db.films.create_index('movie_id', unique=True)
+    await db.films.create_index([('rating_count', pymongo.ASCENDING), ('guild_avg', pymongo.ASCENDING)])
+
+
+async def add_members(db, users):
+    """Register a guild's users in the shared members collection.
+
+    Users new to the guild bring any ratings already in the shared store
+    into the guild's film counters.
+    """
+    shared = shared_db(db)
+    joined = set(await shared.members.distinct('lb_id', {
+        'lb_id': {'$in': [user['lb_id'] for user in users]},
+        'guilds': db.name,
+    }))
+    for user in users:
+        lb_id = user['lb_id']
+        if lb_id in joined:
+            continue
+        # Joining and counting their ratings in is one step to the member's
+        # other writers
+        async with member_locks([lb_id]):
+            result = await shared.members.update_one(
+                {'lb_id': lb_id, 'guilds': {'$ne': db.name}},
+                {'$set': {'lid': user['lid']}, '$push': {'guilds': db.name}})
+            if result.modified_count:
+                await move_member_ratings(shared, db.name, lb_id, joining=True)
+            else:
+                # Not followed anywhere yet, so there are no ratings to count
+                await shared.members.update_one(
+                    {'lb_id': lb_id},
+                    {'$setOnInsert': {'lid': user['lid'], 'guilds': [db.name]}},
+                    upsert=True)
+
+
+async def remove_member(db, lb_id):
+    """Unfollow a user in one guild.
+
+    Their ratings leave the guild's film counters, and the shared store
+    too once no other guild follows them.
+    """
+    shared = shared_db(db)
+    await db.users.delete_many({'lb_id': lb_id})
+    async with member_locks([lb_id]):
+        result = await shared.members.update_one({'lb_id': lb_id, 'guilds': db.name},
+                                                 {'$pull': {'guilds': db.name}})
+        if result.modified_count:
+            await move_member_ratings(shared, db.name, lb_id, joining=False)
+    # Only if still followed nowhere, in case of a concurrent follow
+    result = await shared.members.delete_one({'lb_id': lb_id, 'guilds': {'$size': 0}})
+    if result.deleted_count:
+        await shared.ratings.delete_many({'lb_id': lb_id})
+
+
+async def member_guilds(db, lb_id):
+    """Handles on every guild db following ``lb_id``, whose counters a sync moves."""
+    member = await shared_db(db).members.find_one({'lb_id': lb_id}, {'guilds': 1})
+    names = member['guilds'] if member else [db.name]
+    return [db.client[name] for name in names]
+
+
+async def guild_members(db):
+    """lb_ids counted in the guild's films, the members add_members has
+    joined to it rather than everyone in its users collection."""
+    return await shared_db(db).members.distinct('lb_id', {'guilds': db.name})
+
+
+def averages_pipeline(match):
+    # Group the matched ratings by film into the same fields the running
+    # counters keep
+    rated = {'$ne': ['$rating_id', -1]}
+    return [
+        {'$match': match},
+        {'$group': {
+            '_id': '$movie_id',
+            'sum': {'$sum': {'$cond': [rated, '$rating_id', 0]}},
+            'rating_count': {'$sum': {'$cond': [rated, 1, 0]}},
+            'unrated_count': {'$sum': {'$cond': [rated, 0, 1]}},
+        }},
+        {'$project': {
+            '_id': 0,
+            'movie_id': '$_id',
+            'sum': 1,
+            'rating_count': 1,
+            'unrated_count': 1,
+            'guild_avg': {'$cond': [
+                {'$gt': ['$rating_count', 0]},
+                {'$divide': ['$sum', '$rating_count']},
+                0,
+            ]},
+            'watch_count': {'$add': ['$rating_count', '$unrated_count']},
+        }},
+    ]
+
+
+async def update_film_averages(db, movie_ids=None):
+    # Full recompute of the guild's film counters from its members' shared
+    # ratings, for the migration and for repairing drift. Syncs keep the
+    # counters current through write_ratings instead.
+    shared = shared_db(db)
+    match = {'lb_id': {'$in': await guild_members(db)}}
+    if movie_ids is not None:
+        movie_ids = list(movie_ids)
+        match['movie_id'] = {'$in': movie_ids}
+    pipeline = averages_pipeline(match) + [
+        {'$merge': {
+            'into': {'db': db.name, 'coll': 'films'},
+            'on': 'movie_id',
+            'whenMatched': 'merge',
+            'whenNotMatched': 'insert',
+        }},
+    ]
+    # $merge only runs once the cursor is iterated
+    await shared.ratings.aggregate(pipeline, allowDiskUse=True).to_list(None)
+
+    # Films no member of the guild has seen any more
+    zero = {'$set': {'sum': 0, 'rating_count': 0, 'unrated_count': 0,
+                     'guild_avg': 0, 'watch_count': 0}}
+    seen = await shared.ratings.distinct('movie_id', match)
+    if movie_ids is None:
+        await db.films.update_many({'movie_id': {'$nin': seen}}, zero)
+    else:
+        seen = set(seen)
+        await db.films.update_many(
+            {'movie_id': {'$in': [m for m in movie_ids if m not in seen]}}, zero)
+
+
+async def check_film_counters(db, repair=False):
+    """Compare the guild's running film counters with a full recompute.
+
+    Returns the movie_ids whose counters disagree, rewriting them from
+    the recompute if ``repair`` is set.
+    """
+    shared = shared_db(db)
+    match = {'lb_id': {'$in': await guild_members(db)}}
+    expected = {film['movie_id']: film
+                async for film in shared.ratings.aggregate(averages_pipeline(match),
+                                                           allowDiskUse=True)}
+    mismatched = []
+    async for film in db.films.find({}, {'movie_id': 1, **{field: 1 for field in COUNTERS}}):
+        want = expected.pop(film['movie_id'], {})
+        # rating_ids are scaled for some users, so sums can be fractional
+        if any(abs(film.get(field, 0) - want.get(field, 0)) > 1e-6 for field in COUNTERS):
+            mismatched.append(film['movie_id'])
+    # Rated films with no document at all
+    mismatched += list(expected)
+
+    if repair and mismatched:
+        await update_film_averages(db, mismatched)
+    return mismatched
+
+
+async def sync_guild(db, full=False, use_api=False, progress=None, checkpoint=None):
+    """Sync every user in the guild's users collection.
+
+    Film averages follow along as ratings are written. Members a sync in
+    another guild read within FRESH_FOR are skipped unless ``full`` is
+    set. Safe to cancel: ratings already written stay counted, and the
+    next sync resumes from ``checkpoint`` if given, otherwise from the
+    unchanged watermarks.
+    """
+    progress = progress or SyncProgress()
+    shared = shared_db(db)
+    await ensure_indexes(db)
+    users = await db.users.find({}).to_list(None)
+    await add_members(db, users)
+    lb_ids = [user['lb_id'] for user in users]
+    if not full:
+        fresh = set(await shared.members.distinct('lb_id', {
+            'lb_id': {'$in': lb_ids},
+            'sync_mark.synced_at': {'$gt': datetime.utcnow() - FRESH_FOR},
+        }))
+        progress.users_total += len(fresh)
+        progress.users_done += len(fresh)
+        lb_ids = [lb_id for lb_id in lb_ids if lb_id not in fresh]
+    try:
+        if use_api:
+            members = await shared.members.find({'lb_id': {'$in': lb_ids}}).to_list(None)
+            await get_ratings_api(shared, members, progress=progress, guild=guild_id(db))
+        else:
+            await get_ratings(shared, lb_ids, full=full, progress=progress, guild=guild_id(db),
+                              checkpoint=checkpoint)
+    finally:
+        progress.finished = time.monotonic()
+    return progress
+
+
+async def sync_user(db, user, full=False, use_api=False, progress=None, checkpoint=None):
+    """Sync one user document from the guild's users collection."""
+    progress = progress or SyncProgress()
+    shared = shared_db(db)
+    await ensure_indexes(db)
+    await add_members(db, [user])
+    lb_id = user['lb_id']
+    try:
+        if use_api:
+            await get_ratings_api(shared, [user], progress=progress, guild=guild_id(db))
+        else:
+            await get_ratings(shared, [lb_id], full=full, progress=progress, guild=guild_id(db),
+                              checkpoint=checkpoint)
+    finally:
+        progress.finished = time.monotonic()
+    return progress